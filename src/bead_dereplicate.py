@@ -10,15 +10,23 @@ Created on Thu May 31 09:23:46 2018
 from __future__ import print_function
 from __future__ import division
 from metaSeq import io as seqIO
+from metaSeq import qc as seqQC
+from metaSeq import parallel
 import argparse
 import json
+import multiprocessing
+import sys
 import textwrap
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,\
                                  description=textwrap.dedent('''\
                                                              Remove replicated sequences from the assembled and unassembled stLFR data.
                                                              There is an option to output data as JSON format, which should be a faster
-                                                             alternative.'''),\
+                                                             alternative.
+                                                             Reads with an ambiguous base (N, lower case n or other IUPAC codes) are discarded
+                                                             in both modes, a pair is discarded if any of the two reads has one.
+                                                             With -stream, input files need to be sorted by bead (stlfr_split.py output),
+                                                             beads are written one by one and memory is bounded by the largest beads.'''),\
                                      epilog=textwrap.dedent('''\
                                         ------------------------
                                         By Zewei Song
@@ -32,57 +40,158 @@ parser.add_argument('-single', help='The assembled file.')
 parser.add_argument('-twin', help='The unassembled files, separated by comma: File1,File2')
 parser.add_argument('-o', help='The output sequence file.')
 parser.add_argument('-json', help='The JSON file to save the bead dictionary.')
+parser.add_argument('-stream', action='store_true', help='Input files are sorted by bead (stlfr_split.py output), process and write one bead at a time with bounded memory.')
+parser.add_argument('-t', default=1, type=int, help='Number of processes for the stream mode, default is 1.')
+parser.add_argument('-minQ', type=int, help='Also discard reads with a base under this quality score (Phred+33), FASTQ input only.')
+parser.add_argument('-chunk', default=1000, type=int, help='Number of beads sent to a process at once in the stream mode, default is 1000.')
 
 args = parser.parse_args()
 
+
+# Return the barcode in the label of a record
+def record_barcode(record):
+    return record[0].split('/')[-1]
+
+
+# Dereplicate a list of beads (barcode, assembled reads, unassembled read pairs), reads are (seq, qual)
+# Return a list of (barcode, bead dictionary, FASTA text, number of sequences), beads without
+# any sequence (all with N) are dropped as in the dictionary mode.
+# Reads with an ambiguous base (N or other non ACGT) or a base under minQ are found for the whole
+# chunk at once (qc.base_mask), a pair is discarded if any of the two reads is masked.
+def derep_chunk(chunk, minQ=None):
+    seqs = []
+    quals = []
+    for barcode, singles, twins in chunk:
+        for read in singles + [r for pair in twins for r in pair]:
+            seqs.append(read[0])
+            quals.append(read[1])
+    masked = iter(seqQC.masked_reads(*seqQC.base_mask(seqs, quals, minQ)).tolist())
+    results = []
+    for barcode, singles, twins in chunk:
+        value = {}
+        seqCount = 0
+        for seq, qual in singles:
+            if not next(masked): # Keep sequence without N
+                value.setdefault('s', {})
+                value['s'][seq] = value['s'].get(seq, 0) + 1
+                seqCount += 1
+        for r1, r2 in twins:
+            seq = r1[0] + '_' + r2[0]
+            masked1 = next(masked)
+            masked2 = next(masked)
+            if not (masked1 or masked2): # Keep pair without N
+                value.setdefault('t', {})
+                value['t'][seq] = value['t'].get(seq, 0) + 1
+                seqCount += 1
+        if not value:
+            continue
+        fasta = []
+        count = 0
+        for seq in value.get('s', {}):
+            fasta.append('>{0}\n{1}\n'.format(barcode + '-' + str(count), seq))
+            count += 1
+        for seqs in value.get('t', {}):
+            seqs = seqs.split('_')
+            fasta.append('>{0}\n{1}\n>{2}\n{3}\n'.format(barcode + '-0-' + str(count), seqs[0],
+                                                           barcode + '-1-' + str(count), seqs[1]))
+            count += 1
+        results.append((barcode, value, ''.join(fasta), seqCount))
+    return results
+
+
+# Group the assembled and unassembled files (both sorted by bead) into chunks of beads
+def bead_chunks(singleFile, twinFile, chunkSize):
+    singles = seqIO.bead_groups(seqIO.sequence_block(singleFile, parallel=True), record_barcode)
+    twins = seqIO.bead_groups(seqIO.sequence_twin_block(twinFile[0], twinFile[1], parallel=True),
+                              lambda x: record_barcode(x[0]))
+    chunk = []
+    for barcode, (single, twin) in seqIO.bead_merge(singles, twins):
+        chunk.append((barcode, [(i[1], i[3]) for i in single], [((r1[1], r1[3]), (r2[1], r2[3])) for r1, r2 in twin]))
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Stream mode: beads are dereplicated in chunks (in a pool of workers with -t > 1) and written
+# as soon as they are done, in the input order. At most 2 x threads chunks are in memory.
+# The JSON file is the same single dictionary as the dictionary mode, written bead by bead.
+if args.stream:
+    twinFile = args.twin.split(',')
+    seqCount = 0
+    beadCount = 0
+    fastaOutput = open(args.o, 'w')
+    if args.json:
+        jsonOutput = open(args.json, 'w')
+        jsonOutput.write('{')
+
+    def write_chunk(results):
+        global seqCount, beadCount
+        for barcode, value, fasta, count in results:
+            fastaOutput.write(fasta)
+            if args.json:
+                jsonOutput.write('{0}{1}: {2}'.format(', ' if beadCount else '', json.dumps(barcode), json.dumps(value)))
+            beadCount += 1
+            seqCount += count
+        with open('bead_dereplicate.log', 'w') as f:
+            f.write('Processed {0} sequences. Currently found {1} beads.'.format(seqCount, beadCount))
+
+    chunks = bead_chunks(args.single, twinFile, args.chunk)
+    pool = multiprocessing.get_context('fork').Pool(args.t) if args.t > 1 else None
+    for results in parallel.imap_ordered(pool, derep_chunk, chunks, args.t * 2, (args.minQ,)):
+        write_chunk(results)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    fastaOutput.close()
+    if args.json:
+        jsonOutput.write('}')
+        jsonOutput.close()
+    with open('bead_dereplicate.log', 'w') as f:
+        f.write('Processed {0} sequences. Found {1} beads.'.format(seqCount, beadCount))
+    sys.exit()
+
+# Return the masked reads (qc.base_mask) of a trunk of records, quality scores are used for FASTQ with -minQ
+def masked_trunk(trunk):
+    quals = [i[3] for i in trunk] if len(trunk[0]) == 4 else None
+    return seqQC.masked_reads(*seqQC.base_mask([i[1] for i in trunk], quals, args.minQ)).tolist()
+
+
 # Read in the assembled and unassembled sequences
+# Reads are masked by trunk as in the stream mode, so both modes keep the same reads
 # Assembled file
 singleFile = args.single
-seqSingle = seqIO.sequence(singleFile, fastx='q')
-
 seqCount = 0
 
 bead = {}
-for record in seqSingle:
-    if record[1].find('N') == -1: # Keep sequence without N
-        barcode = record[0].split('/')[-1]
-        try:
-            bead[barcode]['s'][record[1]] += 1
-        except KeyError:
-            bead[barcode] = {'s':{}}
-            bead[barcode]['s'][record[1]] = 1
-        seqCount += 1
-        if seqCount % 1000000 == 0:
-            with open('bead_dereplicate.log', 'w') as f:
-                f.write('Processed {0} sequences. Currently found {1} beads.'\
-                        .format(seqCount, len(bead)))
-    else:
-        pass
-    
+for trunk in seqIO.sequence_trunk(singleFile):
+    for record, masked in zip(trunk, masked_trunk(trunk)):
+        if not masked: # Keep sequence without N
+            barcode = record[0].split('/')[-1]
+            value = bead.setdefault(barcode, {}).setdefault('s', {})
+            value[record[1]] = value.get(record[1], 0) + 1
+            seqCount += 1
+            if seqCount % 1000000 == 0:
+                with open('bead_dereplicate.log', 'w') as f:
+                    f.write('Processed {0} sequences. Currently found {1} beads.'\
+                            .format(seqCount, len(bead)))
+
 # Unasembled forward and reverse reads
 twinFile = args.twin.split(',')
-seqTwin = seqIO.sequence_twin(twinFile[0], twinFile[1], fastx='q')
-
-for r1, r2 in seqTwin:
-    barcode = r1[0].split('/')[-1] # There is no check up for the correspondence of barcode in R1 and R2!
-    seq = r1[1] + '_' + r2[1]
-    if seq.find('N') == -1: # Keep sequence without N
-        try:
-            bead[barcode]['t'][seq] += 1
-        except KeyError:
-            try:
-                bead[barcode]['t'] = {}
-                bead[barcode]['t'][seq] = 1
-            except KeyError:
-                bead[barcode] = {'t':{}}
-                bead[barcode]['t'][seq] = 1
-        seqCount += 1
-        if seqCount % 1000000 == 0:
-            with open('bead_dereplicate.log', 'w') as f:
-                f.write('Processed {0} sequences. Currently found {1} beads.'\
-                        .format(seqCount, len(bead)))
-    else:
-        pass
+for trunk1, trunk2 in seqIO.sequence_twin_block_trunk(twinFile[0], twinFile[1]):
+    for r1, r2, masked1, masked2 in zip(trunk1, trunk2, masked_trunk(trunk1), masked_trunk(trunk2)):
+        barcode = r1[0].split('/')[-1] # There is no check up for the correspondence of barcode in R1 and R2!
+        seq = r1[1] + '_' + r2[1]
+        if not (masked1 or masked2): # Keep pair without N
+            value = bead.setdefault(barcode, {}).setdefault('t', {})
+            value[seq] = value.get(seq, 0) + 1
+            seqCount += 1
+            if seqCount % 1000000 == 0:
+                with open('bead_dereplicate.log', 'w') as f:
+                    f.write('Processed {0} sequences. Currently found {1} beads.'\
+                            .format(seqCount, len(bead)))
 
 with open('bead_dereplicate.log', 'w') as f:
     f.write('Processed {0} sequences. Found {1} beads.'.format(seqCount, len(bead)))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This script contains functions for decoding the stLFR barcodes from Read 2.
+"""
+from __future__ import print_function
+from __future__ import division
+from metaSeq.nucleotide import CODE_ANYCASE as _CODE, LUT as _LUT
+from array import array
+import numpy as np
+
+# A 10 bp barcode is encoded into a 20-bit integer (2 bit per base) with _CODE (str) or _LUT (bytes)
+_WEIGHT = 4 ** np.arange(9, -1, -1, dtype=np.uint32)
+
+# Start position of the three 10 bp barcodes in Read 2 for each barcode string length
+    # 54 bp: 10 + 6 + 10 + 18 + 10 (three sets of 10 base barcode)
+    # 42 bp: 10 + 6 + 10 + 6 + 10 (Cuurently used by CNGB)
+    # R2 may be sequenced as 154 bp while using the 42 bp system, only the first 142 bp are used.
+LAYOUT = {'42': (100, 116, 132), '54': (100, 116, 144)}
+
+
+# Return the Reverse Compliment of a sequence
+def rc(seq):
+    replace_dict = {'A':'T', 'T':'A','C':'G','G':'C'}
+    reverse = seq[::-1].upper()
+    rc = ''
+    for base in reverse:
+        rc += replace_dict[base]
+    return rc
+
+
+# Generate all possible 1 SNP mutation of a given sequence
+    # Original sequence is NOT included in the output
+    # RC is not considered
+    # There is l x 3 + 1 sequences including the original one
+def snp_list(seq):
+    snp_dict = {'A':['T','C','G'], 'T':['A','C','G'],\
+                'C':['A','T','G'], 'G':['A','T','C']}
+    snp_seqs = []
+    for index, base in enumerate(seq): # mutate per base
+        for mutate in snp_dict[base]:
+            seqMutate = seq
+            seqMutate = seqMutate[:index] + mutate + seqMutate[index+1:]
+            snp_seqs.append(seqMutate)
+    return snp_seqs
+
+
+# Return the 20-bit code of a 10 bp barcode, -1 if it is not a 10 bp ACGT string
+def encode(seq):
+    if len(seq) != 10:
+        return -1
+    try:
+        return int(seq.translate(_CODE), 4)
+    except ValueError:
+        return -1
+
+
+# A barcode decoder built from the barcode list (barcode sequence and number separated by tab)
+# Every possible 10-mer is indexed in a flat array (4^10 = 1M entries), the value is the
+# barcode index (+1) it belongs to, 0 for no barcode.
+# Exact, 1 mismatch and reverse complement hits are all resolved in one lookup:
+    # The reverse search (reverseDict[rc(item)], rc barcode with 1 SNP) hits exactly the same
+    # barcode as a 1 SNP forward hit, so both are covered by the same entries.
+    # Exact hits overwrite the SNP ones.
+class barcodeDecoder(object):
+    def __init__(self, barcodeFile, bl='42', offsets=(0,-1,1,-2,2)):
+        self.numbers = [] # barcode number, the index in the table is index + 1
+        barcodes = []
+        with open(barcodeFile, 'r') as f:
+            for line in f:
+                line = line.strip('\n').split('\t')
+                barcodes.append(line[0])
+                self.numbers.append(line[1])
+        self.starts = LAYOUT[bl]
+        self.offsets = tuple(offsets)
+        self.table = array('H', [0]) * (1 << 20)
+        for index, barcode in enumerate(barcodes): # 1 SNP hits
+            for item in snp_list(barcode):
+                self.table[encode(item)] = index + 1
+        for index, barcode in enumerate(barcodes): # exact hits
+            self.table[encode(barcode)] = index + 1
+
+    # Number of 10-mers that can be decoded
+    def __len__(self):
+        return len(self.table) - self.table.count(0)
+
+    # Return the barcode set (number1_number2_number3) of a R2 sequence, None if not found
+    # The offsets are tried in order, the first one with all three barcodes found is used
+    def decode(self, seq):
+        table = self.table
+        for offset in self.offsets:
+            number = []
+            for start in self.starts:
+                window = seq[start+offset:start+offset+10]
+                if len(window) != 10:
+                    break
+                try:
+                    index = table[int(window.translate(_CODE), 4)]
+                except ValueError:
+                    break
+                if index:
+                    number.append(self.numbers[index - 1])
+                else:
+                    break
+            if len(number) == 3:
+                return '_'.join(number)
+        return None
+
+    # Return (start, end) of the part of R2 holding all barcode windows of all offsets
+    def region(self):
+        return min(self.starts) + min(self.offsets), max(self.starts) + max(self.offsets) + 10
+
+    # Decode a batch of R2 sequences (e.g. the R2 trunk of sequence_twin_trunk) at once
+    # Return a (n, 3) uint16 array of barcode index (+1) for each read, a row of 0 if not found
+    # All barcode windows of all offsets are taken from one 2D uint8 array of the batch,
+    # so there is no Python work per read. The result is the same as decode().
+    # The sequences can be cut from position first of R2 (e.g. the region() only), first is then given.
+    def decode_batch(self, seqs, first=0):
+        n = len(seqs)
+        result = np.zeros((n, 3), dtype=np.uint16)
+        if n == 0:
+            return result
+        width = max(self.starts) + max(self.offsets) + 10 - first # bases needed for all windows
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=n)
+        if lengths.min() >= width and lengths.max() == lengths.min(): # same read length, no copy needed
+            batch = np.frombuffer(''.join(seqs).encode('latin-1'), dtype=np.uint8).reshape(n, lengths[0])
+        else: # pad or cut the reads to the same width, short window will not be decoded
+            batch = np.frombuffer(''.join([i[:width].ljust(width) for i in seqs]).encode('latin-1'),
+                                  dtype=np.uint8).reshape(n, width)
+        table = np.frombuffer(self.table, dtype=np.uint16)
+        done = np.zeros(n, dtype=bool)
+        for offset in self.offsets:
+            index = np.zeros((n, 3), dtype=np.uint16)
+            for i, start in enumerate(self.starts):
+                window = _LUT[batch[:, start+offset-first:start+offset-first+10]]
+                code = window.astype(np.uint32) @ _WEIGHT
+                index[:, i] = np.where((window < 4).all(axis=1), table[code & 0xFFFFF], 0)
+            hit = (index > 0).all(axis=1) & ~done
+            result[hit] = index[hit]
+            done |= hit
+        return result
+
+    # Convert the result of decode_batch() into barcode sets (number1_number2_number3), None if not found
+    def labels(self, index):
+        numbers = [None] + self.numbers
+        return ['_'.join((numbers[a], numbers[b], numbers[c])) if a else None for a, b, c in index.tolist()]
@@ -9,6 +9,8 @@ from __future__ import print_function
 from __future__ import division
 from metaSeq import qc as seqQC
 from metaSeq import io as seqIO
+from metaSeq.nucleotide import CODE, CODE_REVCOMP
+import numpy as np
 import json
 
 
@@ -67,6 +69,11 @@ class beadSequence(object):
             f.write('%s\n' % json.dumps({self.barcode: self.assembled + self.unassembled}))
 
 
+    # Write the bead with an opened bead writer (JSON or binary, see metaSeq.io.bead_writer)
+    def beadWrite(self, writer):
+        writer.write({self.barcode: self.assembled + self.unassembled})
+
+
 
 # A class for kmer group of a given bead
 class beadKmer(object):
@@ -258,53 +265,230 @@ class beadMinSet(object):
         return report
 
 #%%
+# Return the integer code of a sequence and of its reverse complement
+# A leading 1 bit keeps the length (AAC and AC are different), None if there is a base other than ACGT
+# The code is exact (one sequence per code), so equal codes are always the same sequence.
+def seq_code(seq):
+    try:
+        head = 1 << (2 * len(seq))
+        return head | int(seq.translate(CODE), 4), head | int(seq[::-1].translate(CODE_REVCOMP), 4)
+    except ValueError:
+        return None
+
+
+# Return the fragment (seq,) or pair (seq1, seq2) in the canonical orientation
+# which is the smaller one of the sequence(s) and the reverse complement
+def canonical_fragment(record):
+    if len(record) == 1:
+        return min((record[0],), (seqIO.revcomp(record[0]),))
+    else:
+        return min((record[0], record[1]), (seqIO.revcomp(record[1]), seqIO.revcomp(record[0])))
+
+
+# Return the canonical key of a fragment (seq,) or pair (seq1, seq2), the same for both orientations
+# The smaller one of the forward and reverse complement codes (seq_code), or the canonical
+# sequence for fragment with a base other than ACGT.
+def fragment_key(record):
+    if len(record) == 1:
+        code = seq_code(record[0])
+        key = min(code) if code else None
+    else:
+        code1 = seq_code(record[0])
+        code2 = seq_code(record[1])
+        key = min((code1[0], code2[0]), (code2[1], code1[1])) if code1 and code2 else None
+    if key is None:
+        key = canonical_fragment(record)
+    return key
+
+
 # Remove duplicated reads from a single bead Class
 # The reverse complimentary sequence is considered
 # Return a new dictionary (used as input of beadSequence())
+    # Each fragment (or pair) is counted by its canonical fragment, computed once for each distinct read.
+    # A new read needs its canonical sequence anyway, so the int codes (fragment_key) are not used here.
 def derep(bead):
     seqs = list(bead.values())[0]
-    derep_dict = {}
+    derep_dict = {} # canonical fragment: count
+    keys = {} # read as it is: canonical fragment, computed once for a read
     for record in seqs:
         if len(record) == 1: # assembled read
-            key = [(record[0],), (seqIO.revcomp(record[0]),)]
-            key.sort(key=lambda x:x[0])
-            key = tuple(key)
-            #print(key)
-            try:
-                derep_dict[key] += 1
-            except KeyError:
-                derep_dict[key] = 1
-        if len(record) == 2: # unassembled reads
-            key = [(record[0], record[1]), (seqIO.revcomp(record[1]), seqIO.revcomp(record[0]))]
-            key.sort(key=lambda x:x[0])
-            key = tuple(key)
-            try:
-                derep_dict[key] += 1
-            except KeyError:
-                derep_dict[key] = 1
+            read = record[0]
+        elif len(record) == 2: # unassembled reads
+            read = (record[0], record[1])
+        else:
+            continue
+        try:
+            key = keys[read]
+        except KeyError:
+            key = canonical_fragment(record)
+            keys[read] = key
+        try:
+            derep_dict[key] += 1
+        except KeyError:
+            derep_dict[key] = 1
     barcode = list(bead.keys())[0]
-    bead_dict = {}
-    for key, value in derep_dict.items():
-        bead_dict[key[0]] = value
-    return {barcode: bead_dict}
+    return {barcode: derep_dict}
+
+
+# Mix 64-bit integers (numpy uint64 array) into well spread hashes (splitmix64 finalizer)
+def mix64(x):
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+
+# Return a stable 64-bit hash (the same in all processes and runs) of a fragment key (fragment_key)
+def key_hash(key):
+    if isinstance(key, int) or isinstance(key[0], int): # int codes, hash() of int is not randomized
+        return hash(key) & 0xFFFFFFFFFFFFFFFF
+    import hashlib
+    return int.from_bytes(hashlib.blake2b('\t'.join(key).encode('latin-1'), digest_size=8).digest(), 'little')
+
+
+# Return the sequences of the fragments in a bead, (seq,) or (seq1, seq2) for each fragment
+# quality=True for the records with quality scores ([seq, qual] or [seq1, qual1, seq2, qual2])
+def fragment_sequences(fragments, quality=False):
+    if quality:
+        return [tuple(record[0::2]) for record in fragments]
+    else:
+        return [tuple(record) for record in fragments]
+
+
+# A count-min sketch of the number of beads containing a fragment, with a fixed memory (bytes)
+# A fragment is hashed by its canonical key (fragment_key), so both orientations are counted together.
+# It is counted once per bead, the estimate is never lower than the true number of beads.
+# Sketches with the same size can be merged (e.g. built by parallel workers).
+# Fragments are the records of a bead, set quality=True for the records with quality scores.
+class fragmentSketch(object):
+    def __init__(self, memory=64*1024**2, depth=4):
+        self.depth = depth
+        self.width = max(memory // (4 * depth), 1)
+        self.table = np.zeros((depth, self.width), dtype=np.uint32)
+        self.rows = np.arange(depth, dtype=np.uint64)[:, None]
+        self.beads = 0
+
+    # Return the hashes of a list of fragments (seq,) or (seq1, seq2)
+    def hashes(self, fragments):
+        return mix64(np.fromiter((key_hash(fragment_key(i)) for i in fragments), dtype=np.uint64, count=len(fragments)))
+
+    # Column in each row for the hashes, (depth, n) array
+    def columns(self, hashes):
+        with np.errstate(over='ignore'):
+            step = (hashes >> np.uint64(32)) | np.uint64(1)
+            return ((hashes[None, :] + self.rows * step[None, :]) % np.uint64(self.width)).astype(np.int64)
+
+    # Add the fragments of a bead, the same fragment is counted once
+    def add(self, fragments, quality=False):
+        hashes = np.unique(self.hashes(fragment_sequences(fragments, quality)))
+        np.add.at(self.table, (np.arange(self.depth)[:, None], self.columns(hashes)), 1)
+        self.beads += 1
+
+    # Return the estimated number of beads for a list of fragments (numpy array)
+    def estimate(self, fragments, quality=False):
+        columns = self.columns(self.hashes(fragment_sequences(fragments, quality)))
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def merge(self, other):
+        if self.table.shape != other.table.shape:
+            raise ValueError('Cannot merge fragmentSketch with different size.')
+        self.table += other.table
+        self.beads += other.beads
+        return self
 
 
 # Remove low quality reads from a single bead Class
 # Return a new bead Class
 # Now always return without quality score (has a return_format value for the future)
-def maxEE(bead, maxee=1, return_format='a'):
-    seqs = list(bead.values())[0]
-    seqs_qc = []
-    p_dict = seqQC.qual_score()
-    for record in seqs:
-        if len(record) == 2: # assembled read
-            if seqQC.ee(record[1], p_dict) < maxee:
-                seqs_qc.append([record[0]])
-        elif len(record) == 4: # unassembled read1 and read2
-            if seqQC.ee(record[1], p_dict) < maxee and seqQC.ee(record[3], p_dict) < maxee:
-                seqs_qc.append([record[0], record[2]])
-    barcode = list(bead.keys())[0]
-    return {barcode: seqs_qc}
+def maxEE(bead, maxee=1, return_format='a', p_array=None):
+    return maxEE_batch([bead], maxee=maxee, p_array=p_array)[0]
+
+
+# Same as maxEE() for a list of beads, EE of all reads is computed in one batch (qc.ee_batch)
+# Return a list of new beads in the same order, a bead can be empty ({barcode: []})
+# Reads and beads are added to qcStat (a qc.qcStats) if it is given.
+def maxEE_batch(beads, maxee=1, p_array=None, qcStat=None):
+    quals = []
+    for bead in beads:
+        for record in list(bead.values())[0]:
+            if len(record) == 2: # assembled read
+                quals.append(record[1])
+            elif len(record) == 4: # unassembled read1 and read2
+                quals.append(record[1])
+                quals.append(record[3])
+    ee = seqQC.ee_batch(quals, p_array)[0]
+    passed = iter((ee < maxee).tolist())
+    beads_qc = []
+    for bead in beads:
+        seqs_qc = []
+        for record in list(bead.values())[0]:
+            if len(record) == 2:
+                if next(passed):
+                    seqs_qc.append([record[0]])
+            elif len(record) == 4:
+                r1 = next(passed)
+                if next(passed) and r1:
+                    seqs_qc.append([record[0], record[2]])
+        beads_qc.append({list(bead.keys())[0]: seqs_qc})
+    if qcStat is not None:
+        qcStat.add_reads(quals, ee)
+        qcStat.add_beads([len(list(i.values())[0]) for i in beads], [len(list(i.values())[0]) for i in beads_qc])
+    return beads_qc
+
+
+# QC, dereplicate and filter a list of beads in one pass (worker of stlfr_bead_process.py)
+    # Beads with 0000 in the barcode are discarded unless keepZero=True
+    # Reads with EE >= maxee are removed (maxEE_batch), then duplicated reads are removed (derep)
+    # With a fragmentSketch, fragments found in more than maxBeads beads are dropped
+    # (abundant='drop') or only reported (abundant='flag') under 'abundant' as {fragment: beads},
+    # 'abundant_occurrences' counts them once per bead they are found in
+    # Beads with no fragment left, or with fragment number out of [minFrag, maxFrag] are discarded
+# Return a list of processed beads (the same as beadSequence(derep(bead)).beadWrite)
+# and a dictionary of the counts for the report, with the qcStat under 'qc' if it is given.
+# Reads are counted as qc.qcStats (a pair is two reads), fragments as a pair or an assembled read.
+def qcDerepFilter(beads, maxee=1, minFrag=None, maxFrag=None, keepZero=False, p_array=None, qcStat=None,
+                  sketch=None, maxBeads=None, abundant='drop'):
+    stats = {'beads': len(beads), 'zero_beads': 0, 'reads': 0, 'reads_pass_ee': 0,
+             'fragments_derep': 0, 'empty_beads': 0, 'out_of_range_beads': 0,
+             'kept_beads': 0, 'kept_fragments': 0, 'abundant_occurrences': 0}
+    if not keepZero:
+        kept = [i for i in beads if '0000' not in list(i.keys())[0].split('_')]
+        stats['zero_beads'] = len(beads) - len(kept)
+        beads = kept
+    stats['reads'] = sum([len(record) // 2 for i in beads for record in list(i.values())[0]]) # [seq, qual] per read
+    processed = []
+    flagged = {}
+    for beadQC in maxEE_batch(beads, maxee=maxee, p_array=p_array, qcStat=qcStat):
+        beadDerep = derep(beadQC)
+        stats['reads_pass_ee'] += sum([len(record) for record in list(beadQC.values())[0]]) # [seq] per read
+        if sketch is not None:
+            derepDict = list(beadDerep.values())[0]
+            fragments = list(derepDict.keys())
+            if fragments:
+                for fragment, count in zip(fragments, sketch.estimate(fragments).tolist()):
+                    if count > maxBeads:
+                        stats['abundant_occurrences'] += 1
+                        flagged[fragment] = count
+                        if abundant == 'drop':
+                            del derepDict[fragment]
+        beadProcessed = beadSequence(beadDerep)
+        fragNumber = len(beadProcessed.fragments)
+        stats['fragments_derep'] += fragNumber
+        if fragNumber == 0:
+            stats['empty_beads'] += 1
+        elif (minFrag is not None and fragNumber < minFrag) or (maxFrag is not None and fragNumber > maxFrag):
+            stats['out_of_range_beads'] += 1
+        else:
+            stats['kept_beads'] += 1
+            stats['kept_fragments'] += fragNumber
+            processed.append({beadProcessed.barcode: beadProcessed.assembled + beadProcessed.unassembled})
+    if qcStat is not None:
+        stats['qc'] = qcStat
+    if sketch is not None:
+        stats['abundant'] = flagged
+    return processed, stats
 
 
 #%% Winner take all (wta) methods for finding the minimum set of alignments (all possible hits)
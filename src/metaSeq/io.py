@@ -10,6 +10,14 @@ This script contains functions that take a sequence file as input.
 """
 from __future__ import print_function
 from __future__ import division
+from metaSeq.nucleotide import CODE
+from itertools import chain, islice, groupby, product
+import numpy as np
+from operator import itemgetter
+from array import array
+import heapq
+import struct
+import sys
 
 # Function for checking the file type (gz, fasta, fastq)
 # Return a tuple with two boolean value (T/F, T/F) --> (gz/not_gz, FASTQ/FASTA)
@@ -25,11 +33,11 @@ def showMeTheType(filePath):
     else:
         fileType.append(False)
     if fileType[0]:
-        with gzip.open(filePath, 'rt') as f:
-            headSymbol = f.readline()[0]
+        with gzip.open(filePath, 'rb') as f:
+            headSymbol = f.read(1).decode('latin-1')
     else:
-        with open(filePath, 'r') as f:
-            headSymbol = f.readline()[0]
+        with open(filePath, 'rb') as f:
+            headSymbol = f.read(1).decode('latin-1')
     fileType.append(seqType[headSymbol])
     return tuple(fileType)
 
@@ -67,40 +75,32 @@ class sequence(object):
 
 
 # Same iterator but read in multiple record into memory at once
-# By testing, read in file in trunk does not boost the reading speed.
+# Built on the block reader (sequence_block), each iteration returns a list of trunk_size records.
+# fastx is kept for the old calls, the file type is checked from the file.
 class sequence_trunk(object):
-    def __init__(self, filePath, trunk_size=100000):
-        fileType = showMeTheType(filePath)
-        if fileType[0]:
-            import gzip
-            self.file = gzip.open(filePath, 'rt')
-        else:
-            self.file = open(filePath, 'r')
-
-        if fileType[1]:
-            self.n = 4
-        else:
-            self.n = 2
+    def __init__(self, filePath, trunk_size=100000, fastx=None, parallel=False):
+        self.records = sequence_block(filePath, parallel=parallel)
+        self.n = self.records.n
+        self.trunk_size = trunk_size
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        record_trunk = []
-        for record in range(self.trunk_size):
-            record = []
-            for i in range(self.n):
-                line = self.file.readline().strip('\n')
-                if line:
-                    record.append(line)
-                else:
-                    if len(record_trunk) > 0:
-                        return record_trunk
-                    else:
-                        raise StopIteration
-            record[0] = record[0][1:]
-            record_trunk.append(record)
-        return record_trunk
+        record_trunk = list(islice(self.records, self.trunk_size))
+        if record_trunk:
+            return record_trunk
+        else:
+            raise StopIteration
+
+    def close(self):
+        self.records.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 # Iterator for two files
@@ -185,15 +185,220 @@ class sequence_twin_trunk(object):
         return r1_trunk, r2_trunk
 
 
-# This function is still under test, it reads in file bytes, should be a bit faster than read in by line
-# Need to find a way to remove header symbol
-# This is 40% faster than reading by line.
+# Open a sequence file in binary mode, gz file is decompressed on the fly
+# Set parallel=True to decompress the gz file in the background (see gzip_reader)
+def open_binary(filePath, parallel=False):
+    if filePath.endswith('.gz'):
+        if parallel:
+            return gzip_reader(filePath)
+        import gzip
+        return gzip.open(filePath, 'rb')
+    else:
+        return open(filePath, 'rb')
+
+
+# Read a gz file with the decompression running outside of the parser.
+# pigz or igzip is used as a subprocess if it can be found in the PATH, otherwise a
+# background thread inflates the file with gzip (zlib releases the GIL while working).
+# Decompressed blocks are passed to the parser through a bounded queue.
+# Only read() is supported, it returns one decompressed block (b'' at the end of file).
+# close() stops the subprocess or the thread (also when the file is not finished), use it or with.
+class gzip_reader(object):
+    def __init__(self, filePath, size=4194304, queue_size=16, tool=None):
+        import shutil
+        self.filePath = filePath
+        self.size = size
+        self.process = None
+        self.stopped = False
+        if tool is None:
+            for item in ('pigz', 'igzip'):
+                if shutil.which(item):
+                    tool = item
+                    break
+        if tool:
+            import subprocess
+            self.process = subprocess.Popen([tool, '-dc', filePath], stdout=subprocess.PIPE)
+            self.file = self.process.stdout
+        else:
+            import threading
+            import queue
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.inflate, daemon=True)
+            self.thread.start()
+
+    # Worker of the background thread, None is put in the queue at the end of file
+    def inflate(self):
+        import gzip
+        try:
+            with gzip.open(self.filePath, 'rb') as f:
+                while not self.stopped:
+                    block = f.read(self.size)
+                    if not block:
+                        break
+                    self.queue.put(block)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, size=-1):
+        if self.process:
+            block = self.file.read(self.size)
+            if not block and self.process.wait() != 0:
+                raise IOError('Failed to decompress {0} (exit code {1}).'.format(self.filePath, self.process.returncode))
+            return block
+        block = self.queue.get()
+        if block is None:
+            self.queue.put(None) # keep returning b'' on the following calls
+            return b''
+        elif isinstance(block, Exception):
+            raise block
+        return block
+
+    # Terminate the subprocess if it is still running, or stop the thread (the queue is
+    # emptied so that the thread is not blocked on a full queue) and wait for it
+    def close(self):
+        if self.process:
+            self.file.close()
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+        else:
+            import queue
+            self.stopped = True
+            while self.thread.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self.thread.join(0.01)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Read a sequence file by large binary blocks and return the records by block
+# Lines are split by bytes.split() on the whole block (no readline() per line),
+# the incomplete lines/record at the end of a block are carried to the next block.
+# Each yield is a list of records with the same fields as sequence() (as tuples), header symbol removed.
+# The records of a block are built in one pass by zipping the line slices (no loop per record).
+def read_blocks(file, n, size=4194304):
+    tail = ''
+    while True:
+        block = file.read(size)
+        if not block:
+            break
+        lines = (tail + block.decode('latin-1')).split('\n')
+        tail = lines.pop() # the last line is not finished yet
+        keep = len(lines) - len(lines) % n
+        if keep < len(lines): # carry the unfinished record to the next block
+            tail = '\n'.join(lines[keep:] + [tail])
+            del lines[keep:]
+        if keep:
+            yield block_records(lines, n)
+    if tail: # last record without a line breaker at the end of file
+        lines = [i for i in tail.split('\n') if i]
+        del lines[len(lines) - len(lines) % n:]
+        if lines:
+            yield block_records(lines, n)
+
+
+# Return the records (tuples of n fields) of a list of lines, the header symbol is removed
+def block_records(lines, n):
+    labels = [i[1:] for i in lines[0::n]]
+    return list(zip(labels, *[lines[i::n] for i in range(1, n)]))
+
+
+# Iterator on a single sequence file using the block reader. This is a drop-in of sequence().
+# It will NOT check the format of the file, either can it deal with multiple line FASTA file.
+# Set parallel=True to decompress gz file in the background.
+# close() (or with) closes the file and stops the background decompression.
+class sequence_block(object):
+    def __init__(self, filePath, size=4194304, parallel=False):
+        fileType = showMeTheType(filePath)
+        self.file = open_binary(filePath, parallel=parallel)
+        if fileType[1]:
+            self.n = 4
+        else:
+            self.n = 2
+        self.records = chain.from_iterable(read_blocks(self.file, self.n, size))
+
+    # The records are iterated directly from the blocks, there is no __next__ call per record
+    def __iter__(self):
+        return self.records
+
+    def __next__(self):
+        return next(self.records)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Iterator on two files using the block reader. This is a drop-in of sequence_twin().
+# It only work for files with ABSOLUTELY corresponding record.
+# With parallel=True, R1 and R2 are decompressed in two separated background workers.
+class sequence_twin_block(object):
+    def __init__(self, file_r1, file_r2, size=4194304, parallel=False):
+        fileType = showMeTheType(file_r1)
+        fileType_2 = showMeTheType(file_r2)
+        if fileType[0] != fileType_2[0] or fileType[1] != fileType_2[1]:
+            print('Inconsistent file type, are you serious?')
+        self.r1 = sequence_block(file_r1, size=size, parallel=parallel)
+        self.r2 = sequence_block(file_r2, size=size, parallel=parallel)
+        self.n = self.r1.n
+        self.records = zip(self.r1.records, self.r2.records)
+
+    def __iter__(self):
+        return self.records
+
+    def __next__(self):
+        return next(self.records)
+
+    def close(self):
+        self.r1.close()
+        self.r2.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Same as sequence_twin_block, but return trunk_size records from each file at once.
+# This is a drop-in of sequence_twin_trunk().
+class sequence_twin_block_trunk(sequence_twin_block):
+    def __init__(self, file_r1, file_r2, trunk_size=100000, size=4194304, parallel=False):
+        sequence_twin_block.__init__(self, file_r1, file_r2, size=size, parallel=parallel)
+        self.trunk_size = trunk_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        r1_trunk = list(islice(self.r1.records, self.trunk_size))
+        r2_trunk = list(islice(self.r2.records, self.trunk_size))
+        if r1_trunk:
+            return r1_trunk, r2_trunk
+        else:
+            raise StopIteration
+
+
+# Read in a file by bytes, and return a list of records for every block of (about) size bytes.
+# Built on read_blocks(), the header symbol is removed as in the other iterators.
 class sequence_bytes(object):
     def __init__(self, filePath, size = 1000000,fastx='a'):
-        self.file = open(filePath, 'r')
+        self.file = open_binary(filePath)
         self.size = size
         self.fastx = fastx
-        self.tail = ''
 
         if fastx == 'a':
             self.n = 2
@@ -201,33 +406,13 @@ class sequence_bytes(object):
             self.n = 4
         else:
             print('Please specify the right format, "a" for FASTA and "q" for FASTQ.')
+        self.blocks = read_blocks(self.file, self.n, self.size)
+
     def __iter__(self):
         return self
 
     def __next__(self):
-        content = self.file.read(self.size)
-
-        if content:
-            content = self.tail + content
-            self.tail = ''
-            content = content.split('\n')
-            self.tail = content[-1]
-            tail_n = (len(content) - 1) % 4 # Set the line step to 4, set to 2 for FASTA
-            if tail_n > 0:
-                self.tail = '\n'.join(content[:-1][-1*tail_n::]) + '\n' + self.tail
-            else:
-                self.tail = self.tail
-            #print(self.tail)
-            content = content[:(len(content) - tail_n - 1)]
-            content = [content[x:x+self.n] for x in range(0, len(content), self.n)]
-            return content
-        else:
-            if self.tail:
-                content = self.tail.split('\n')
-                content = [content[x:x+self.n] for x in range(0, len(content), self.n)]
-                return content
-            else:
-                raise StopIteration
+        return next(self.blocks)
 
 
 # Write the content to a fastx file
@@ -250,6 +435,40 @@ def write_seqs(seq_content, filePath, fastx='a', mode='w'):
     return count
 
 
+# A writer for FASTA/FASTQ records that stays open, as write_seqs() but without reopening the file
+# Output is gzip compressed with a level (1-9), or if the file name ends with .gz (level 6 by default).
+class sequence_writer(object):
+    def __init__(self, filePath, fastx='a', level=None, size=1048576):
+        if fastx == 'a':
+            self.header = '>'
+        elif fastx == 'q':
+            self.header = '@'
+        else:
+            self.header = '-_-b'
+        if level is not None or filePath.endswith('.gz'):
+            import gzip
+            self.file = gzip.open(filePath, 'wt', compresslevel=6 if level is None else level, newline='')
+        else:
+            self.file = open(filePath, 'w', newline='', buffering=size)
+        self.count = 0
+
+    # Write a list of records, return the number of records written
+    def write(self, seq_content):
+        header = self.header
+        self.file.write(''.join([header + '\n'.join(record) + '\n' for record in seq_content]))
+        self.count += len(seq_content)
+        return len(seq_content)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 #%% Functions for alignment
 class alignment(object):
     def __init__(self, alnFile):
@@ -356,7 +575,7 @@ def fastq2json(fwdFile, revFile, barcodePosition=-2):
 def mergepairs2bead(assemFile, fwdFile, revFile):
     bead = {} # Dictionary for storing bead
     ft = showMeTheType(assemFile)
-    for record in sequence(assemFile):
+    for record in sequence_block(assemFile):
         if ft[1]:
             barcode = record[0].split('/')[-2]
             try:
@@ -374,7 +593,7 @@ def mergepairs2bead(assemFile, fwdFile, revFile):
     if ft1 != ft2:
         print('Inconsisten forward and reverse file, come on, dude!')
     else:
-        for r1, r2 in sequence_twin(fwdFile, revFile):
+        for r1, r2 in sequence_twin_block(fwdFile, revFile):
             if ft1[1]:
                 barcode = r1[0].split('/')[-2]
                 try:
@@ -382,6 +601,7 @@ def mergepairs2bead(assemFile, fwdFile, revFile):
                 except KeyError:
                     bead[barcode] = [[r1[1], r1[3], r2[1], r2[3]]]
             else:
+                barcode = r1[0].split('/')[-2]
                 try:
                     bead[barcode].append([r1[1], r2[1]])
                 except KeyError:
@@ -389,24 +609,230 @@ def mergepairs2bead(assemFile, fwdFile, revFile):
         return bead
 
 
+# Streaming version of mergepairs2bead() for files sorted by bead (e.g. from stlfr_split.py)
+# The assembled and the unassembled files are merged by barcode, each bead is returned as
+# {barcode: fragments} as soon as it is complete, in the order of barcode.
+# The fragments are the same as mergepairs2bead(), assembled reads first.
+# Raise ValueError if a file is not sorted by bead.
+def mergepairs2bead_stream(assemFile, fwdFile, revFile, parallel=False):
+    ft = showMeTheType(assemFile)
+    ft1 = showMeTheType(fwdFile)
+    ft2 = showMeTheType(revFile)
+    if ft1 != ft2:
+        raise ValueError('Inconsistent forward and reverse files: {0} and {1}.'.format(fwdFile, revFile))
+    label = lambda x: x[0].split('/')[-2]
+    assem = bead_groups(sequence_block(assemFile, parallel=parallel), label)
+    twin = bead_groups(sequence_twin_block(fwdFile, revFile, parallel=parallel), lambda x: label(x[0]))
+    for barcode, (records, pairs) in bead_merge(assem, twin):
+        if ft[1]:
+            fragments = [[record[1], record[3]] for record in records]
+        else:
+            fragments = [[record[1]] for record in records]
+        if ft1[1]:
+            fragments += [[r1[1], r1[3], r2[1], r2[3]] for r1, r2 in pairs]
+        else:
+            fragments += [[r1[1], r2[1]] for r1, r2 in pairs]
+        yield {barcode: fragments}
+
+
 # Convert a pair of FASTQ record into list format as [seq1, q1, seq2, q2]
 # All labels are discarded
 def fastq2list(r1, r2):
     return [r1[1], r1[3], r2[1], r2[3]]
 
 
+# Sort records by bead with a bounded memory (external sort), for splitting a whole lane into beads
+# A record is a tuple of strings, the first one is the bead (barcode set) and used as the sort key.
+# Records are kept in memory until their estimated size reaches memory (bytes). Then they are
+# sorted and written into a binary run file (field lengths + latin-1 bytes) in a temporary folder.
+# Iterating the sorter merges all runs (and the records left in memory) with a heap.
+# At most fanIn run files are opened at once, more runs are first merged by groups into
+# larger runs (as many rounds as needed). Records of the same bead keep their input order.
+class bead_sorter(object):
+    def __init__(self, fields, memory=4*1024**3, tempDir=None, runBuffer=1048576, fanIn=256):
+        self.fields = fields
+        self.struct = struct.Struct('<' + 'I' * fields)
+        self.overhead = 64 + 57 * fields # Python object overhead of a record (tuple + strings)
+        self.memory = memory
+        self.tempDir = tempDir
+        self.runBuffer = runBuffer
+        self.fanIn = max(2, fanIn)
+        self.folder = None
+        self.runs = []
+        self.runCount = 0
+        self.buffer = []
+        self.size = 0
+        self.count = 0
+
+    def add(self, record):
+        self.buffer.append(record)
+        self.size += self.overhead + sum(map(len, record))
+        self.count += 1
+        if self.size >= self.memory:
+            self.spill()
+
+    # Sort the records in memory and write them to a new run file
+    def spill(self):
+        if not self.buffer:
+            return
+        self.buffer.sort(key=itemgetter(0))
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    # Write sorted records into a new run file in the temporary folder, return the file name
+    def write_run(self, records):
+        import os
+        import tempfile
+        if self.folder is None:
+            self.folder = tempfile.mkdtemp(prefix='bead_sorter_', dir=self.tempDir)
+        runFile = os.path.join(self.folder, '{0}.run'.format(self.runCount))
+        self.runCount += 1
+        pack = self.struct.pack
+        with open(runFile, 'wb', buffering=self.runBuffer) as f:
+            for record in records:
+                fields = [i.encode('latin-1') for i in record]
+                f.write(pack(*map(len, fields)))
+                f.write(b''.join(fields))
+        return runFile
+
+    # Merge the runs by groups of fanIn until one more file (the records in memory) can be added
+    # Groups are consecutive runs, so records of the same bead keep their input order.
+    def reduce_runs(self):
+        import os
+        while len(self.runs) >= self.fanIn:
+            runs = []
+            for i in range(0, len(self.runs), self.fanIn):
+                group = self.runs[i:i+self.fanIn]
+                if len(group) == 1:
+                    runs.append(group[0])
+                    continue
+                runs.append(self.write_run(heapq.merge(*[self.read_run(j) for j in group], key=itemgetter(0))))
+                for j in group:
+                    os.remove(j)
+            self.runs = runs
+
+    # Read back the records of a run file
+    def read_run(self, runFile):
+        unpack = self.struct.unpack
+        size = self.struct.size
+        with open(runFile, 'rb', buffering=self.runBuffer) as f:
+            while True:
+                head = f.read(size)
+                if not head:
+                    break
+                lengths = unpack(head)
+                content = f.read(sum(lengths)).decode('latin-1')
+                record = []
+                start = 0
+                for length in lengths:
+                    record.append(content[start:start+length])
+                    start += length
+                yield tuple(record)
+
+    # Iterate all records in bead order, temporary files are removed at the end
+    def __iter__(self):
+        import shutil
+        self.buffer.sort(key=itemgetter(0))
+        try:
+            self.reduce_runs()
+            streams = [self.read_run(i) for i in self.runs] + [iter(self.buffer)]
+            for record in heapq.merge(*streams, key=itemgetter(0)):
+                yield record
+        finally:
+            if self.folder is not None:
+                shutil.rmtree(self.folder, ignore_errors=True)
+                self.folder = None
+                self.runs = []
+
+    # Iterate by bead, return (bead, list of records)
+    def beads(self):
+        for bead, records in groupby(self, key=itemgetter(0)):
+            yield bead, list(records)
+
+
+# Group consecutive records of a bead-sorted stream, yield (barcode, list of records)
+# key is the function returning the barcode of a record.
+# A barcode smaller than the previous one means the stream is not sorted, raise ValueError.
+def bead_groups(records, key):
+    previous = None
+    for barcode, group in groupby(records, key):
+        if previous is not None and barcode < previous:
+            raise ValueError('Input is not sorted by bead: {0} after {1}.'.format(barcode, previous))
+        previous = barcode
+        yield barcode, list(group)
+
+
+def _tag_stream(stream, i):
+    for barcode, records in stream:
+        yield barcode, i, records
+
+
+# Merge several bead-sorted streams of (barcode, records) (e.g. from bead_groups)
+# Yield (barcode, [records of stream 1, records of stream 2, ...]), [] if a stream does not have the bead.
+def bead_merge(*streams):
+    tagged = [_tag_stream(stream, i) for i, stream in enumerate(streams)]
+    for barcode, group in groupby(heapq.merge(*tagged, key=itemgetter(0)), key=itemgetter(0)):
+        merged = [[] for i in streams]
+        for item in group:
+            if merged[item[1]]:
+                raise ValueError('Input is not sorted by bead: {0} found twice.'.format(barcode))
+            merged[item[1]] = item[2]
+        yield barcode, merged
+
+
+# Build the index of a JSON bead file, and save it to a sidecar file (filePath + '.idx' by default)
+# One line per bead: barcode, byte offset, line length (bytes) and fragment count, separated by tab
+# Barcodes are expected to be unique in a bead file.
+# Return the number of indexed beads.
+def bead_json_index(filePath, indexFile=None):
+    import json
+    if indexFile is None:
+        indexFile = filePath + '.idx'
+    count = 0
+    offset = 0
+    with open(filePath, 'rb') as f, open(indexFile, 'w') as out:
+        for line in f:
+            if line.strip():
+                bead = json.loads(line)
+                for barcode, fragments in bead.items():
+                    out.write('{0}\t{1}\t{2}\t{3}\n'.format(barcode, offset, len(line), len(fragments)))
+                    count += 1
+            offset += len(line)
+    return count
+
+
+# Read in the sidecar index of a JSON bead file, build it if missing or older than the bead file
+# Return a dictionary in file order {barcode: (offset, length, fragment count)}
+def load_bead_json_index(filePath, indexFile=None):
+    import os
+    if indexFile is None:
+        indexFile = filePath + '.idx'
+    if not os.path.isfile(indexFile) or os.path.getmtime(indexFile) < os.path.getmtime(filePath):
+        bead_json_index(filePath, indexFile)
+    index = {}
+    with open(indexFile, 'r') as f:
+        for line in f:
+            line = line.strip('\n').split('\t')
+            index[line[0]] = (int(line[1]), int(line[2]), int(line[3]))
+    return index
+
+
 # Iterator for Bead from the JSON output
+# With the index (see bead_json_index), beads can be read in directly by barcode (get),
+# by random sampling (sample) or by fragment number (fragment_range), without reading the whole file.
 class bead_json(object):
-    def __init__(self, filePath):
+    def __init__(self, filePath, indexFile=None):
         import json
+        self.filePath = filePath
+        self.indexFile = indexFile
+        self.offsets = None
+        self.random = None # opened with the index, for get()
         self.file = open(filePath, 'r')
         self.head = []
         with open(filePath, 'r') as f:
-            i = 1
-            for line in f:
-                if i <= 10:
-                    i += 1
-                    self.head.append(json.loads(line.strip('\n')))
+            for line in islice(f, 10):
+                self.head.append(json.loads(line.strip('\n')))
     def __iter__(self):
         return self
 
@@ -417,6 +843,407 @@ class bead_json(object):
             return json.loads(line)
         else:
             raise StopIteration
+
+    # Return the index as {barcode: (offset, length, fragment count)}, built if needed
+    def index(self):
+        if self.offsets is None:
+            self.offsets = load_bead_json_index(self.filePath, self.indexFile)
+            self.random = open(self.filePath, 'rb')
+        return self.offsets
+
+    # Return a single bead by its barcode
+    def get(self, barcode):
+        import json
+        offset, length, fragmentCount = self.index()[barcode]
+        self.random.seek(offset)
+        return json.loads(self.random.read(length))
+
+    # Return n randomly sampled beads, in the order of the file
+    def sample(self, n, seed=None):
+        return bead_sample(self, n, seed)
+
+    # Iterate the beads with minFrag <= fragment number <= maxFrag
+    def fragment_range(self, minFrag, maxFrag):
+        return bead_fragment_range(self, minFrag, maxFrag)
+
+    # Close the file, and the one opened by index() for get()
+    def close(self):
+        self.file.close()
+        if self.random is not None:
+            self.random.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Random sampling and fragment range filter on an indexed bead file (bead_json or bead_binary)
+# Only the selected beads are read in, the last value of an index entry is the fragment count.
+def bead_sample(beadFile, n, seed=None):
+    import random
+    index = beadFile.index()
+    selected = set(random.Random(seed).sample(list(index.keys()), n))
+    return [beadFile.get(i) for i in index.keys() if i in selected]
+
+
+def bead_fragment_range(beadFile, minFrag, maxFrag):
+    for barcode, value in beadFile.index().items():
+        if minFrag <= value[-1] <= maxFrag:
+            yield beadFile.get(barcode)
+
+
+# Writer for the JSON bead file, one bead ({barcode: fragments}) per line
+class bead_json_writer(object):
+    def __init__(self, filePath, mode='w'):
+        self.file = open(filePath, mode, newline='')
+        self.count = 0
+
+    def write(self, bead):
+        import json
+        self.file.write('%s\n' % json.dumps(bead))
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#%% Binary bead file (.bead)
+# A compact container of beads, read in as the same {barcode: fragments} of bead_json.
+# Layout (little endian):
+    # header:  magic b'MSQBEAD1'
+    # beads:   one block per bead (see bead_binary_writer.write)
+    # index:   per bead, barcode length (H) + barcode + block offset (Q) + fragment count (I)
+    # trailer: index offset (Q) + bead count (Q) + magic
+# In a block, all 2-bit packed sequences are stored together, followed by the other
+# strings (qualities, or sequences that are not pure ACGT) stored as they are.
+BEAD_MAGIC = b'MSQBEAD1'
+_BLOCK_HEAD = struct.Struct('<IHI') # payload size, barcode length, fragment count
+_INDEX_ENTRY = struct.Struct('<QI') # block offset, fragment count
+_TRAILER = struct.Struct('<QQ8s') # index offset, bead count, magic
+_NOT_ACGT = str.maketrans('', '', 'ACGT')
+_UNPACK = np.array([[ord(j) for j in i] for i in product('ACGT', repeat=4)], dtype=np.uint8) # byte value to 4 bases
+
+
+# Pack a sequence of ACGT into 2 bits per base, the first base is the highest bits
+def pack_seq(seq):
+    return int(seq.translate(CODE), 4).to_bytes((len(seq) + 3) // 4, 'big')
+
+
+# Unpack length bases from bytes packed by pack_seq()
+def unpack_seq(data, length):
+    return _UNPACK[np.frombuffer(data, dtype=np.uint8)].tobytes().decode('latin-1')[len(data) * 4 - length:]
+
+
+# Decode the payload of a bead block (bytes or memoryview) into (barcode, fragments)
+# Set quality=False to skip the raw strings (quality scores), they are returned as None.
+# All sequences are unpacked and all raw strings decoded at once, then sliced by their lengths.
+def decode_bead_block(payload, barcodeLength, fragmentCount, quality=True):
+    payload = memoryview(payload)
+    barcode = bytes(payload[:barcodeLength]).decode('latin-1')
+    start = barcodeLength
+    fieldCount = np.frombuffer(payload[start:start+fragmentCount], dtype=np.uint8)
+    start += fragmentCount
+    n = int(fieldCount.sum())
+    kinds = np.frombuffer(payload[start:start+n], dtype=np.uint8).astype(bool)
+    start += n
+    lengths = np.frombuffer(payload[start:start+4*n], dtype='<u4').astype(np.int64)
+    start += 4 * n
+    # Position of the fields in the unpacked sequences (padded to 4 bases) and the raw strings
+    seqLength = lengths[kinds]
+    seqEnd = np.cumsum((seqLength + 3) // 4 * 4)
+    rawLength = lengths[~kinds]
+    rawEnd = np.cumsum(rawLength)
+    rawStart = start + (int(seqEnd[-1]) // 4 if len(seqEnd) else 0)
+    packed = unpack_seq(payload[start:rawStart], (rawStart - start) * 4)
+    fields = [packed[i:j] for i, j in zip((seqEnd - seqLength).tolist(), seqEnd.tolist())]
+    if quality:
+        raw = bytes(payload[rawStart:]).decode('latin-1')
+        fields += [raw[i:j] for i, j in zip((rawEnd - rawLength).tolist(), rawEnd.tolist())]
+    else:
+        fields += [None] * len(rawLength)
+    if len(rawLength) and len(seqLength): # put the fields back to their original order
+        order = np.argsort(~kinds, kind='stable')
+        inverse = np.empty(n, dtype=np.int64)
+        inverse[order] = np.arange(n)
+        fields = [fields[i] for i in inverse.tolist()]
+    fragmentEnd = np.cumsum(fieldCount, dtype=np.int64)
+    fragments = [fields[i:j] for i, j in zip((fragmentEnd - fieldCount).tolist(), fragmentEnd.tolist())]
+    return barcode, fragments
+
+
+# Writer for the binary bead file, bead is the same {barcode: fragments} dictionary of JSON bead
+# Fragments are lists of strings (up to 255 per fragment), e.g. [seq, qual, seq, qual]
+class bead_binary_writer(object):
+    def __init__(self, filePath):
+        self.file = open(filePath, 'wb')
+        self.file.write(BEAD_MAGIC)
+        self.index = []
+        self.count = 0
+
+    def write(self, bead):
+        for barcode, fragments in bead.items():
+            barcode = barcode.encode('latin-1')
+            fieldCount = bytearray()
+            kinds = bytearray()
+            lengths = array('I')
+            packed = []
+            raw = []
+            for fragment in fragments:
+                fieldCount.append(len(fragment))
+                for item in fragment:
+                    lengths.append(len(item))
+                    if item and not item.translate(_NOT_ACGT): # pure ACGT
+                        kinds.append(1)
+                        packed.append(pack_seq(item))
+                    else:
+                        kinds.append(0)
+                        raw.append(item.encode('latin-1'))
+            if sys.byteorder != 'little':
+                lengths.byteswap()
+            payload = b''.join([barcode, bytes(fieldCount), bytes(kinds), lengths.tobytes()] + packed + raw)
+            self.index.append((barcode, self.file.tell(), len(fragments)))
+            self.file.write(_BLOCK_HEAD.pack(len(payload), len(barcode), len(fragments)))
+            self.file.write(payload)
+            self.count += 1
+
+    # Write the index and trailer, the file is not readable without closing the writer
+    def close(self):
+        indexOffset = self.file.tell()
+        for barcode, offset, fragmentCount in self.index:
+            self.file.write(struct.pack('<H', len(barcode)) + barcode + _INDEX_ENTRY.pack(offset, fragmentCount))
+        self.file.write(_TRAILER.pack(indexOffset, len(self.index), BEAD_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Parse the index of a binary bead file into {barcode: (block offset, fragment count)}
+def parse_bead_index(content, count):
+    offsets = {}
+    start = 0
+    for i in range(count):
+        length = struct.unpack_from('<H', content, start)[0]
+        start += 2
+        barcode = bytes(content[start:start+length]).decode('latin-1')
+        start += length
+        offsets[barcode] = _INDEX_ENTRY.unpack_from(content, start)
+        start += _INDEX_ENTRY.size
+    return offsets
+
+
+# Iterator for Bead from the binary bead file, return the same {barcode: fragments} as bead_json
+# Set quality=False to skip decoding the quality scores (returned as None). Strings that are not
+# pure ACGT (e.g. sequences with N) are stored with the quality scores, they are skipped too.
+class bead_binary(object):
+    def __init__(self, filePath, quality=True):
+        self.file = open(filePath, 'rb')
+        self.quality = quality
+        if self.file.read(len(BEAD_MAGIC)) != BEAD_MAGIC:
+            raise ValueError('{0} is not a binary bead file.'.format(filePath))
+        self.file.seek(-_TRAILER.size, 2)
+        self.indexOffset, self.count, magic = _TRAILER.unpack(self.file.read(_TRAILER.size))
+        if magic != BEAD_MAGIC:
+            raise ValueError('{0} is not complete, the writer may not be closed.'.format(filePath))
+        self.file.seek(len(BEAD_MAGIC))
+        self.offsets = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.file.tell() >= self.indexOffset:
+            raise StopIteration
+        return self.read_block()
+
+    def __len__(self):
+        return self.count
+
+    # Read the bead block at the current position
+    def read_block(self):
+        size, barcodeLength, fragmentCount = _BLOCK_HEAD.unpack(self.file.read(_BLOCK_HEAD.size))
+        barcode, fragments = decode_bead_block(self.file.read(size), barcodeLength, fragmentCount, self.quality)
+        return {barcode: fragments}
+
+    # Return the index as {barcode: (block offset, fragment count)}
+    def index(self):
+        if self.offsets is None:
+            position = self.file.tell()
+            self.file.seek(self.indexOffset)
+            content = self.file.read()[:-_TRAILER.size]
+            self.file.seek(position)
+            self.offsets = parse_bead_index(content, self.count)
+        return self.offsets
+
+    # Return a single bead by its barcode
+    def get(self, barcode):
+        position = self.file.tell()
+        self.file.seek(self.index()[barcode][0])
+        bead = self.read_block()
+        self.file.seek(position)
+        return bead
+
+    # Return n randomly sampled beads, in the order of the file
+    def sample(self, n, seed=None):
+        return bead_sample(self, n, seed)
+
+    # Iterate the beads with minFrag <= fragment number <= maxFrag
+    def fragment_range(self, minFrag, maxFrag):
+        return bead_fragment_range(self, minFrag, maxFrag)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Memory-mapped access to a bead file (binary, or JSON with its sidecar index)
+# Nothing is decoded when the file is opened, a bead is returned as a bead_view on the mapped
+# memory and decoded only when its fragments are accessed. Processes mapping the same file
+# share one copy in the page cache. Pickling (e.g. to a worker process) re-maps the file.
+# Beads can be accessed by position or barcode: beads[0], beads['12_34_56'], or iterated.
+# close() (or with) copies the beads still in use out of the map before closing it.
+class bead_mmap(object):
+    def __init__(self, filePath, indexFile=None):
+        import mmap
+        import weakref
+        self.views = weakref.WeakSet() # bead_view on the map, released by close()
+        self.filePath = filePath
+        self.indexFile = indexFile
+        self.file = open(filePath, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.binary = self.map[:len(BEAD_MAGIC)] == BEAD_MAGIC
+        if self.binary:
+            indexOffset, count, magic = _TRAILER.unpack(self.map[-_TRAILER.size:])
+            if magic != BEAD_MAGIC:
+                raise ValueError('{0} is not complete, the writer may not be closed.'.format(filePath))
+            with memoryview(self.map) as view:
+                offsets = parse_bead_index(view[indexOffset:len(self.map)-_TRAILER.size], count)
+            self.entries = [(barcode, offset, fragmentCount) for barcode, (offset, fragmentCount) in offsets.items()]
+        else:
+            offsets = load_bead_json_index(filePath, indexFile)
+            self.entries = [(barcode, offset, fragmentCount) for barcode, (offset, length, fragmentCount) in offsets.items()]
+            self.lengths = [i[1] for i in offsets.values()]
+        self.position = {item[0]: i for i, item in enumerate(self.entries)}
+
+    def __reduce__(self):
+        return (bead_mmap, (self.filePath, self.indexFile))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for i in range(len(self.entries)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        i = self.position[key] if isinstance(key, str) else key
+        barcode, offset, fragmentCount = self.entries[i]
+        if self.binary:
+            size, barcodeLength, fragmentCount = _BLOCK_HEAD.unpack_from(self.map, offset)
+            start = offset + _BLOCK_HEAD.size
+            with memoryview(self.map) as view:
+                bead = bead_view(barcode, fragmentCount, view[start:start+size], barcodeLength)
+        else:
+            with memoryview(self.map) as view:
+                bead = bead_view(barcode, fragmentCount, view[offset:offset+self.lengths[i]])
+        self.views.add(bead)
+        return bead
+
+    # The map can not be closed while memoryviews on it exist, the beads in use are copied first
+    def close(self):
+        for bead in list(self.views):
+            bead.release()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# A bead on a memory-mapped file (see bead_mmap), raw is the memoryview of the bead
+# (the JSON line, or the payload of the binary block). Fragments are decoded on access.
+class bead_view(object):
+    def __init__(self, barcode, fragmentCount, raw, barcodeLength=None):
+        self.barcode = barcode
+        self.fragmentCount = fragmentCount
+        self.raw = raw
+        self.barcodeLength = barcodeLength # None for JSON
+        self.decoded = None
+
+    # All fragments of the bead, decoded at the first access
+    @property
+    def fragments(self):
+        if self.decoded is None:
+            if self.barcodeLength is None:
+                import json
+                self.decoded = json.loads(bytes(self.raw))[self.barcode]
+            else:
+                self.decoded = decode_bead_block(self.raw, self.barcodeLength, self.fragmentCount)[1]
+        return self.decoded
+
+    # Fragments with the sequences only, quality scores are not decoded for binary file (None)
+    def sequences(self):
+        if self.decoded is None and self.barcodeLength is not None:
+            return decode_bead_block(self.raw, self.barcodeLength, self.fragmentCount, quality=False)[1]
+        return self.fragments
+
+    # Return the bead as {barcode: fragments}, the same as bead_json
+    def bead(self):
+        return {self.barcode: self.fragments}
+
+    # Copy the bead out of the mapped memory and release the memoryview (called by bead_mmap.close)
+    def release(self):
+        if isinstance(self.raw, memoryview):
+            raw = bytes(self.raw)
+            self.raw.release()
+            self.raw = raw
+
+
+# Return the reader for a bead file, binary or JSON is decided by the first bytes
+# quality=False only works for the binary file (quality scores are not decoded)
+def bead_reader(filePath, quality=True):
+    with open(filePath, 'rb') as f:
+        head = f.read(len(BEAD_MAGIC))
+    if head == BEAD_MAGIC:
+        return bead_binary(filePath, quality=quality)
+    else:
+        return bead_json(filePath)
+
+
+# Return the writer for a bead file, binary for the .bead extension, otherwise JSON
+def bead_writer(filePath):
+    if filePath.endswith('.bead'):
+        return bead_binary_writer(filePath)
+    else:
+        return bead_json_writer(filePath)
+
+
+# Convert a bead file between JSON and binary, the output format is decided by bead_writer()
+def bead_convert(inputFile, outputFile):
+    with bead_writer(outputFile) as f:
+        for bead in bead_reader(inputFile):
+            f.write(bead)
+    return f.count
+
 #%%
 # Return reverse compliment of a sequence
 # This part is got from Stakoverflow
@@ -9,28 +9,89 @@ Created on Thu Jul  5 10:50:36 2018
 from __future__ import print_function
 from __future__ import division
 from metaSeq import io as seqIO
+from metaSeq import qc as seqQC
+from metaSeq import bead as seqBead
+from metaSeq.nucleotide import LUT
 import random
+import struct
 import numpy as np
 #%%
 # Return the kmer list of a given sequences
 # It will return all kmer in both strand WITHOUT dereplication
 # So the kmer will be REDUNDANT in the output
-def kmer(seq, size):
+# With skipN=True, kmers with an ambiguous base (N or other non ACGT, see qc.base_mask) are skipped.
+# positions can be given as the start of the kept forward kmers (e.g. from qc.clean_windows).
+def kmer(seq, size, skipN=False, positions=None):
     seq = seq.upper()
     seq_length = len(seq)
+    if positions is None:
+        if skipN:
+            positions = np.flatnonzero(seqQC.clean_windows(*seqQC.base_mask([seq]), size)).tolist()
+        else:
+            positions = range(seq_length - size + 1)
     kmer = []
-    for i in range(seq_length - size + 1):
+    for i in positions:
         kmer.append(seq[i:i+size])
     seq_rev = seqIO.revcomp(seq)
-    for i in range(seq_length - size + 1):
-        kmer.append(seq_rev[i:i+size])
+    for i in reversed(positions): # the same kmers in the reverse complement
+        kmer.append(seq_rev[seq_length-size-i:seq_length-i])
     return kmer
 
+
+# Return the canonical kmers (size <= 32) of a set of sequences (e.g. all sequences of a bead)
+# as a sorted unique uint64 array. A kmer is coded by 2 bits per base, the canonical one is the
+# smaller code of the kmer and its reverse complement, so both strands are counted once.
+# Kmers with an ambiguous base (N or other non ACGT) are skipped.
+# All windows of all sequences are coded at once, adding one base per step for both strands.
+def canonical_kmers(seqs, size):
+    if not 0 < size <= 32:
+        raise ValueError('Kmer size should be between 1 and 32, got {0}.'.format(size))
+    codes = LUT[np.frombuffer(''.join(seqs).encode('latin-1'), dtype=np.uint8)]
+    starts = np.cumsum([0] + [len(seq) for seq in seqs])
+    windows = seqQC.clean_windows(codes == 4, starts, size)
+    n = len(codes) - size + 1 # windows starting at every position, the clean ones are kept at the end
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    complement = (3 - codes).astype(np.uint64)
+    codes = codes.astype(np.uint64)
+    for i in range(size):
+        forward <<= np.uint64(2)
+        forward |= codes[i:i+n]
+        reverse |= complement[i:i+n] << np.uint64(2 * i)
+    return sorted_unique(np.minimum(forward, reverse)[windows[:n]])
+
+
+# Return the sorted unique values of an array (sort then drop repeats, faster than np.unique here)
+def sorted_unique(values):
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    keep = np.empty(len(values), dtype=bool)
+    keep[0] = True
+    np.not_equal(values[1:], values[:-1], out=keep[1:])
+    return values[keep]
+
+
+# Return the kmer string of a kmer code (from canonical_kmers)
+def decode_kmer(code, size):
+    code = int(code)
+    return ''.join(['ACGT'[(code >> (2 * (size - 1 - i))) & 3] for i in range(size)])
+
+
 # Return a kmer table with abundance on the given kmer length for a set of sequences
 # The input sequences is all in a list or tuple (seq1, seq2, seq3)
-def kmerCount(bead, size):
+# With skipN=True, kmers with an ambiguous base are skipped (the masks of all sequences are done at once).
+def kmerCount(bead, size, skipN=False):
     seqs = [i[1] for i in bead.fastaSequences()]
-    kmer_list = [item for seq in seqs for item in kmer(seq, size)]
+    if skipN:
+        windows = seqQC.clean_windows(*seqQC.base_mask(seqs), size)
+        starts = np.cumsum([0] + [len(seq) for seq in seqs]).tolist()
+        kmer_list = [item for seq, start, end in zip(seqs, starts, starts[1:])
+                     for item in kmer(seq, size, positions=np.flatnonzero(windows[start:end]).tolist())]
+    else:
+        kmer_list = [item for seq in seqs for item in kmer(seq, size)]
 #    for item in seqs:
 #        kmer_list += kmer(item, size)
     kmer_table = {}
@@ -60,14 +121,60 @@ class kmerTable(object):
             return None
 
 
+# Return a kmerArray of the canonical integer kmers of a bead (see canonical_kmers)
+def kmerArrayCount(bead, size):
+    seqs = [i[1] for i in bead.fastaSequences()]
+    return kmerArray(canonical_kmers(seqs, size), bead.barcode, size)
+
+
+# A class for the kmers of a given sequence set, stored as a sorted uint64 array
+# The same interface as kmerTable, self.set is the array that can be used by kmerDistance.
+class kmerArray(object):
+    def __init__(self, kmers, barcode, kmerSize):
+        self.kmers = kmers
+        self.kmerSize = kmerSize
+        self.set = kmers
+        self.barcode = barcode
+
+    # Reture the minimizer of current kmer set (first kmer sorted)
+    def minimizer(self):
+        return decode_kmer(self.kmers[0], self.kmerSize)
+
+    # Random sample the kmer pool
+    def randomSample(self, sampleSize):
+        if sampleSize <= len(self.kmers):
+            return [decode_kmer(i, self.kmerSize) for i in random.sample(self.kmers.tolist(), sampleSize)]
+        else:
+            return None
+
+
+# Return the number of shared values of two sorted unique arrays
+# The smaller array is searched in the larger one (searchsorted merge).
+def shared_count(arrayA, arrayB):
+    if len(arrayA) > len(arrayB):
+        arrayA, arrayB = arrayB, arrayA
+    if len(arrayA) == 0:
+        return 0
+    index = np.searchsorted(arrayB, arrayA)
+    index[index == len(arrayB)] = 0
+    return int(np.count_nonzero(arrayB[index] == arrayA))
+
+
 # Return distance of two kmer pool
 # Input is a pair of lists/tuples, containing two kmerTable class.self.set
     # This is usually the output of itertools.combinations
+# The pools can also be the sorted arrays of kmerArray, kmerLength is needed for them (ValueError if not given).
+# For the hashes of kmerSketch, give sketchSize to estimate the Jaccard index as Mash does.
 class kmerDistance(object):
-    def __init__(self, kmerPools):
+    def __init__(self, kmerPools, kmerLength=None, sketchSize=None):
         self.poolA = kmerPools[0]
         self.poolB = kmerPools[1]
-        self.kmerLength = len(list(self.poolA)[0])
+        self.sketchSize = sketchSize
+        if kmerLength is None:
+            if isinstance(self.poolA, np.ndarray):
+                raise ValueError('kmerLength is needed for the kmer arrays and sketches.')
+            kmerLength = len(next(iter(self.poolA)))
+        self.kmerLength = kmerLength
     
     # Return overlap of two kmerSet
     def overlap(self, smallSet, largeSet):
@@ -81,6 +188,13 @@ class kmerDistance(object):
     def jaccard(self):
         lengthA = len(self.poolA)
         lengthB = len(self.poolB)
+        if self.sketchSize:
+            return sketch_jaccard(self.poolA, self.poolB, self.sketchSize)
+        if isinstance(self.poolA, np.ndarray):
+            lengthShared = shared_count(self.poolA, self.poolB)
+            if lengthA + lengthB == 0: # no kmer in both beads (all reads shorter than kmer or masked)
+                return 0
+            return lengthShared / (lengthA + lengthB - lengthShared)
         if lengthA <= lengthB:
             overlapKmer = self.overlap(self.poolA, self.poolB)
         else:
@@ -101,4 +215,220 @@ class kmerDistance(object):
     # Return the kmer distance, accounted for kmer abundance, usng Euclidean distance
     # May need to standardize before calculating
     def kmer_euclidean(set1, set2, size):
-        pass
\ No newline at end of file
+        pass
+
+#%% Bottom-k MinHash sketch
+# A bead is represented by the sketchSize smallest hashes of its canonical kmers (as Mash sketch),
+# the Jaccard index of two beads is estimated from their sketches only (sketch_jaccard).
+# Kmer codes are hashed with splitmix64 (bead.mix64 after adding the golden gamma), a bijection
+# of 64-bit integers, so different kmers never share a hash.
+_GAMMA = np.uint64(0x9e3779b97f4a7c15)
+
+
+# Return the hashes of kmer codes (uint64 array)
+def hash_kmers(kmers):
+    with np.errstate(over='ignore'):
+        return seqBead.mix64(np.asarray(kmers, dtype=np.uint64) + _GAMMA)
+
+
+# Return the sorted sketchSize smallest hashes of a sorted unique kmer array
+def bottom_sketch(kmers, sketchSize):
+    hashes = hash_kmers(kmers)
+    if len(hashes) > sketchSize:
+        hashes = np.partition(hashes, sketchSize - 1)[:sketchSize]
+    return np.sort(hashes)
+
+
+# Return the Jaccard index estimated from two sorted sketches (Mash):
+# the sketchSize smallest hashes of the union are taken, the fraction shared by both sketches is the estimate.
+def sketch_jaccard(hashesA, hashesB, sketchSize):
+    merged = np.sort(np.concatenate((hashesA, hashesB)))
+    if len(merged) == 0:
+        return 0
+    shared = merged[1:] == merged[:-1] # a hash found in both sketches is next to itself
+    union = len(merged) - int(np.count_nonzero(shared))
+    if union > sketchSize: # only count the shared hashes within the bottom of the union
+        cutoff = merged[np.flatnonzero(np.concatenate(([True], ~shared)))[sketchSize - 1]]
+        shared &= merged[1:] <= cutoff
+        union = sketchSize
+    return int(np.count_nonzero(shared)) / union
+
+
+# Return a kmerSketch of a bead (see bottom_sketch)
+def sketchCount(bead, size, sketchSize):
+    kmers = kmerArrayCount(bead, size).kmers
+    return kmerSketch(bottom_sketch(kmers, sketchSize), bead.barcode, size, sketchSize, len(kmers))
+
+
+# A class for the bottom-k sketch of a bead, self.set is the sorted hashes that can be used by
+# kmerDistance (with sketchSize). count is the number of kmers in the bead.
+class kmerSketch(object):
+    def __init__(self, hashes, barcode, kmerSize, sketchSize, count):
+        self.hashes = hashes
+        self.set = hashes
+        self.barcode = barcode
+        self.kmerSize = kmerSize
+        self.sketchSize = sketchSize
+        self.count = count
+
+    # Return Mash distance to another sketch
+    def distance(self, other):
+        return kmerDistance((self.set, other.set), self.kmerSize, self.sketchSize).mashDistance()
+
+
+# Sketch file, all sketches have the same kmer and sketch size
+# Layout (little endian):
+    # header:  magic b'MSQSKCH1' + kmer size (H) + sketch size (I)
+    # sketches: per bead, barcode length (H) + hash count (I) + kmer count (Q) + barcode + hashes (Q)
+SKETCH_MAGIC = b'MSQSKCH1'
+_SKETCH_HEAD = struct.Struct('<HI') # kmer size, sketch size
+_SKETCH_ENTRY = struct.Struct('<HIQ') # barcode length, hash count, kmer count
+
+
+# Writer for the sketch file, write() takes a list of kmerSketch
+class sketch_writer(object):
+    def __init__(self, filePath, kmerSize, sketchSize):
+        self.file = open(filePath, 'wb')
+        self.file.write(SKETCH_MAGIC + _SKETCH_HEAD.pack(kmerSize, sketchSize))
+        self.kmerSize = kmerSize
+        self.sketchSize = sketchSize
+        self.count = 0
+
+    def write(self, sketches):
+        for sketch in sketches:
+            if sketch.kmerSize != self.kmerSize or sketch.sketchSize != self.sketchSize:
+                raise ValueError('Sketch of {0} is not k={1} s={2}.'.format(sketch.barcode, self.kmerSize, self.sketchSize))
+            barcode = sketch.barcode.encode('latin-1')
+            hashes = np.asarray(sketch.hashes, dtype='<u8')
+            self.file.write(_SKETCH_ENTRY.pack(len(barcode), len(hashes), sketch.count) + barcode + hashes.tobytes())
+            self.count += 1
+        return len(sketches)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Iterator for the kmerSketch in a sketch file
+class sketch_reader(object):
+    def __init__(self, filePath):
+        self.file = open(filePath, 'rb')
+        if self.file.read(len(SKETCH_MAGIC)) != SKETCH_MAGIC:
+            raise ValueError('{0} is not a sketch file.'.format(filePath))
+        self.kmerSize, self.sketchSize = _SKETCH_HEAD.unpack(self.file.read(_SKETCH_HEAD.size))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        head = self.file.read(_SKETCH_ENTRY.size)
+        if not head:
+            self.file.close()
+            raise StopIteration
+        barcodeLength, n, count = _SKETCH_ENTRY.unpack(head)
+        barcode = self.file.read(barcodeLength).decode('latin-1')
+        hashes = np.frombuffer(self.file.read(8 * n), dtype='<u8').astype(np.uint64)
+        return kmerSketch(hashes, barcode, self.kmerSize, self.sketchSize, count)
+
+
+# Return True if the file is a sketch file
+def is_sketch(filePath):
+    with open(filePath, 'rb') as f:
+        return f.read(len(SKETCH_MAGIC)) == SKETCH_MAGIC
+
+
+#%% Inverted index for candidate pairs
+# Return the bead pairs sharing at least minShared values (sketch hashes or kmers), instead of all pairs
+# pools is a list of sorted unique uint64 arrays (kmerSketch.set or kmerArray.set), one per bead.
+# The inverted index (value -> beads) is the column of the incidence matrix, values found in more than
+# maxFreq beads are skipped (ubiquitous kmers would make every bead a candidate of each other, 0 for no cap).
+# The shared counts are sparse products by blocks of rows (block_shared), memory grows with the pairs found.
+# Return three arrays: first and second (index in pools, first < second, in the order of combinations)
+# and the number of values they share.
+def candidate_pairs(pools, minShared=1, maxFreq=1000, memory=268435456):
+    matrix = incidence_matrix(pools, 2, maxFreq) # a value in one bead is shared by no pair
+    result = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))]
+    for first, second, shared in block_shared(matrix, memory, minShared):
+        result.append((first, second, shared.astype(np.int64)))
+    return tuple(np.concatenate(i) for i in zip(*result))
+
+
+#%% Blocked distance matrix
+# Return the bead x value incidence matrix (scipy.sparse CSR, one row per pool) of sorted unique
+# uint64 arrays (kmerArray.set or kmerSketch.set), columns are the sorted unique values of all pools.
+# Only the values found in minFreq to maxFreq pools (0 for no limit) are kept as columns.
+# One argsort of all values gives both the column of each value and the number of pools it is in.
+def incidence_matrix(pools, minFreq=1, maxFreq=0):
+    from scipy import sparse
+    lengths = np.array([len(i) for i in pools], dtype=np.int64)
+    values = np.concatenate([np.asarray(i, dtype=np.uint64) for i in pools] + [np.zeros(0, dtype=np.uint64)])
+    order = np.argsort(values)
+    values = values[order]
+    new = np.ones(len(values), dtype=bool)
+    np.not_equal(values[1:], values[:-1], out=new[1:])
+    del values
+    column = np.cumsum(new, dtype=np.int32) - 1
+    frequency = np.diff(np.append(np.flatnonzero(new), len(new)))
+    keep = frequency >= minFreq
+    if maxFreq:
+        keep &= frequency <= maxFreq
+    indices = np.empty(len(new), dtype=np.int32) # sorted within a row as the pools
+    indices[order] = (np.cumsum(keep, dtype=np.int32) - 1)[column]
+    kept = np.empty(len(new), dtype=bool)
+    kept[order] = keep[column]
+    del order, new, column
+    if not kept.all():
+        rows = np.repeat(np.arange(len(pools)), lengths)
+        lengths = np.bincount(rows[kept], minlength=len(pools))
+        indices = indices[kept]
+    indptr = np.concatenate(([0], np.cumsum(lengths)))
+    data = np.ones(len(indices), dtype=np.int32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(pools), int(keep.sum())))
+
+
+# Return the shared counts of all bead pairs (first < second) sharing at least minShared values, block by block
+# The shared counts of a block of rows against all beads are one sparse product of the incidence
+# matrix, the number of rows is set so that a block (as dense) fits in memory (bytes).
+# Pairs are filtered before they are sorted, only the kept ones are put in the order of combinations.
+# Yield three arrays per block: first and second (index in rows) and shared count.
+def block_shared(matrix, memory=268435456, minShared=1):
+    other = matrix.T.tocsr()
+    n = matrix.shape[0]
+    rows = max(1, memory // (max(n, 1) * 40)) # index and count of the product, and the distances
+    for start in range(0, n, rows):
+        product = matrix[start:start+rows] @ other
+        first = np.repeat(np.arange(start, start + product.shape[0], dtype=np.int64), np.diff(product.indptr))
+        keep = (product.indices > first) & (product.data >= minShared)
+        first = first[keep]
+        second = product.indices[keep].astype(np.int64)
+        shared = product.data[keep]
+        del product, keep
+        order = np.argsort(first * n + second)
+        yield first[order], second[order], shared[order]
+
+
+# Return the Mash distance of all bead pairs within threshold (min, max, included), block by block
+# The shared counts come from block_shared(), the threshold is applied in each block, only the edges
+# in range are kept. Yield three arrays per block: first and second (index in pools, first < second,
+# in the order of combinations) and distance.
+# For sketches (kmerSketch.set) give sketchSize, the Jaccard index of the pairs sharing a hash is then
+# estimated by sketch_jaccard (the same as kmerDistance), otherwise it is the one of the given sets.
+# Pairs sharing nothing (distance 1) are not reported.
+def block_distance(pools, kmerSize, threshold=(0, 1), memory=268435456, sketchSize=None):
+    matrix = incidence_matrix(pools)
+    lengths = np.diff(matrix.indptr)
+    for first, second, shared in block_shared(matrix, memory):
+        union = lengths[first] + lengths[second] - shared
+        jac = shared / union
+        if sketchSize: # the union is cut at sketchSize, shared hashes may be out of the bottom
+            for i in np.flatnonzero(union > sketchSize).tolist():
+                jac[i] = sketch_jaccard(pools[first[i]], pools[second[i]], sketchSize)
+        with np.errstate(divide='ignore'):
+            distance = np.where(jac > 0, (-1/kmerSize) * np.log((2 * jac)/(1 + jac)), 1)
+        keep = (threshold[0] <= distance) & (distance <= threshold[1])
+        yield first[keep], second[keep], distance[keep]
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This script contains the 2-bit code of the bases (A/C/G/T = 0/1/2/3) used by the other modules.
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+
+
+# Translation table for str.translate(), the bases are turned into their codes
+# All other characters are turned into 'x', so int(seq, 4) raises a ValueError.
+def _translation(bases, codes):
+    table = {i: 'x' for i in range(256)}
+    table.update({ord(k): v for k, v in zip(bases, codes)})
+    return table
+
+# Code of a sequence: int(seq.translate(CODE), 4), upper case ACGT only
+CODE = _translation('ACGT', '0123')
+# Code of the reverse complement: int(seq[::-1].translate(CODE_REVCOMP), 4)
+CODE_REVCOMP = _translation('ACGT', '3210')
+# Same as CODE, lower case acgt too
+CODE_ANYCASE = _translation('ACGTacgt', '01230123')
+
+# Same encoding on bytes (numpy uint8 array) for the batch functions, ACGTacgt = 0/1/2/3/0/1/2/3,
+# 4 for all other characters
+LUT = np.full(256, 4, dtype=np.uint8)
+for k, v in zip(b'ACGTacgt', (0, 1, 2, 3, 0, 1, 2, 3)):
+    LUT[k] = v
+# True for the bytes of ACGTacgt
+ACGT = LUT < 4
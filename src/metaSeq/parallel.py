@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This script contains functions for processing a stream of items in a pool of workers.
+"""
+from __future__ import print_function
+from __future__ import division
+from collections import deque
+
+
+# Apply func to the items of an iterable in a pool of workers (multiprocessing.Pool), and yield
+# the results in the input order. At most depth items (e.g. 2 x threads) are in the pool at a time,
+# the next item is only read when the first result is taken, so memory is bounded for any input size
+# (Pool.imap reads all items ahead). Extra args are passed to func after the item.
+# With pool=None, the items are processed one by one in this process.
+def imap_ordered(pool, func, items, depth, args=()):
+    if pool is None:
+        for item in items:
+            yield func(item, *args)
+        return
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,) + tuple(args)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
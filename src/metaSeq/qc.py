@@ -7,26 +7,33 @@ Created on Mon Dec 11 16:59:32 2017
 """
 from __future__ import print_function
 from __future__ import division
+from metaSeq.nucleotide import ACGT
+import numpy as np
 
 #%% Generate a look up dictionary for quality score, the value is P instead of Q
-def qual_score():
-#    qual = {}
-    qual_list = ['"', '#', '$', '%', '&', "'", '(', ')', '*', '+', ',', '-', '.', '/', \
-                '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', ':', ';', '<', '=', \
-                '>', '?', '@', 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
-#    i = 1
-#    for char in qual_list:
-#        qual[i] = char
-#        i += 1
+# All printable characters from the offset to '~' are included (Q0 to Q93 for Phred+33,
+# Q0 to Q62 for Phred+64), Q0 (! for Phred+33) means N.
+def qual_score(offset=33):
     p = {}
-    i = 1
-    for char in qual_list:
-        p[char] = 10**(-1*i/10)
-        i += 1
-    p['!'] = 1 # Add ! (means N)
+    for q in range(127 - offset):
+        p[chr(offset + q)] = 10**(-1*q/10)
     return p
 
 
+# Look up table of P for the byte value of a quality character (256 entries)
+# Built from qual_score() (or a given p_dict), -1 for the characters out of the table
+def qual_array(p_dict=None, offset=33):
+    if p_dict is None:
+        p_dict = qual_score(offset)
+    p_array = np.full(256, -1.0)
+    for char, p in p_dict.items():
+        p_array[ord(char)] = p
+    return p_array
+
+
+_QUAL_ARRAY = qual_array() # default Phred+33 table for the batch functions
+
+
 #%%
 # Return a list of Probabilities based on the Phred Q score
 def prob(qual, p_dict):
@@ -38,6 +45,164 @@ def ee(qual, p_dict):
     return sum(prob(qual, p_dict))
 
 
+# Expected error of a batch of quality strings in one call
+# All strings are joined and looked up as one uint8 array, there is no Python work per read.
+# Return four numpy arrays (ee, rate, p, starts):
+    # ee: EE of each read, rate: EE/bp of each read (0 for empty string)
+    # p: error probability of each base for all reads, concatenated
+    # starts: start of each read in p (n + 1), p[starts[i]:starts[i+1]] is read i
+# EE is summed per read on the flat array (np.add.reduceat), memory is bounded by the number of bases.
+# The sum can differ from ee() in the last bits (numpy adds in pairs).
+# Raise ValueError for a character out of the table.
+def ee_batch(quals, p_array=None):
+    if p_array is None:
+        p_array = _QUAL_ARRAY
+    lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+    starts = np.zeros(len(quals) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=starts[1:])
+    codes = np.frombuffer(''.join(quals).encode('latin-1'), dtype=np.uint8)
+    p = p_array[codes]
+    if (p < 0).any():
+        bad = np.unique(codes[p < 0]).tobytes().decode('latin-1')
+        raise ValueError('Quality character out of range: {0}'.format(repr(bad)))
+    ee = np.zeros(len(quals))
+    if len(p):
+        ee[lengths > 0] = np.add.reduceat(p, starts[:-1][lengths > 0])
+    rate = ee / np.maximum(lengths, 1)
+    return ee, rate, p, starts
+
+
+# Return the EE from the first base to each base of all reads (concatenated as p of ee_batch)
+# Reads of the same length are summed together as the rows of a 2D array, so the values are the same
+# as adding the bases one by one (trunc_ee_rate), and memory is bounded by the number of bases.
+def ee_cumulative(p, starts):
+    lengths = np.diff(starts)
+    cumulative = np.zeros(len(p))
+    for length in np.unique(lengths[lengths > 0]).tolist():
+        index = starts[:-1][lengths == length][:, None] + np.arange(length)
+        cumulative[index] = np.cumsum(p[index], axis=1)
+    return cumulative
+
+
+# Streaming QC statistics with fixed-size histograms
+# Reads and beads are added by batch while the QC is running, nothing is kept but the histograms.
+# Accumulators of parallel workers are combined by merge(), the report is written by write().
+    # per-position mean quality (first maxLength bases), read length (>= maxLength in the last bin)
+    # EE of reads (bins of maxEE/eeBins, >= maxEE in the last bin)
+    # fragments per bead (>= maxFragment in the last bin), fraction of fragments discarded per bead
+class qcStats(object):
+    def __init__(self, maxLength=300, maxFragment=1000, maxEE=10, eeBins=100, fractionBins=20, offset=33):
+        self.maxLength = maxLength
+        self.maxFragment = maxFragment
+        self.maxEE = maxEE
+        self.eeBins = eeBins
+        self.fractionBins = fractionBins
+        self.offset = offset
+        self.reads = 0
+        self.beads = 0
+        self.qualSum = np.zeros(maxLength, dtype=np.int64)
+        self.qualCount = np.zeros(maxLength, dtype=np.int64)
+        self.lengthHist = np.zeros(maxLength + 1, dtype=np.int64)
+        self.eeHist = np.zeros(eeBins + 1, dtype=np.int64)
+        self.fragmentHist = np.zeros(maxFragment + 1, dtype=np.int64)
+        self.discardHist = np.zeros(fractionBins, dtype=np.int64)
+
+    # Add a batch of quality strings, EE of the reads can be given if it is already computed
+    def add_reads(self, quals, ee=None):
+        if ee is None:
+            ee = ee_batch(quals, qual_array(offset=self.offset))[0]
+        lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+        score = np.frombuffer(''.join(quals).encode('latin-1'), dtype=np.uint8).astype(np.int64) - self.offset
+        position = np.arange(len(score)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        inRange = position < self.maxLength
+        self.qualSum += np.bincount(position[inRange], weights=score[inRange], minlength=self.maxLength).astype(np.int64)
+        self.qualCount += np.bincount(position[inRange], minlength=self.maxLength)
+        self.lengthHist += np.bincount(np.minimum(lengths, self.maxLength), minlength=self.maxLength + 1)
+        eeBin = np.minimum((np.asarray(ee) / self.maxEE * self.eeBins).astype(np.int64), self.eeBins)
+        self.eeHist += np.bincount(eeBin, minlength=self.eeBins + 1)
+        self.reads += len(quals)
+
+    # Add a batch of beads with the number of fragments before and after the QC
+    def add_beads(self, fragments, kept):
+        fragments = np.asarray(fragments, dtype=np.int64)
+        kept = np.asarray(kept, dtype=np.int64)
+        self.fragmentHist += np.bincount(np.minimum(fragments, self.maxFragment), minlength=self.maxFragment + 1)
+        discard = 1 - kept[fragments > 0] / fragments[fragments > 0]
+        fractionBin = np.minimum((discard * self.fractionBins).astype(np.int64), self.fractionBins - 1)
+        self.discardHist += np.bincount(fractionBin, minlength=self.fractionBins)
+        self.beads += len(fragments)
+
+    # Add the counts of another qcStats (with the same settings) into this one
+    def merge(self, other):
+        if (self.maxLength, self.maxFragment, self.maxEE, self.eeBins, self.fractionBins) != \
+           (other.maxLength, other.maxFragment, other.maxEE, other.eeBins, other.fractionBins):
+            raise ValueError('Cannot merge qcStats with different histogram settings.')
+        self.reads += other.reads
+        self.beads += other.beads
+        for name in ('qualSum', 'qualCount', 'lengthHist', 'eeHist', 'fragmentHist', 'discardHist'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    # Return the report as a dictionary of {section: [(bin, value), ...]}
+    def report(self):
+        eeStep = self.maxEE / self.eeBins
+        fractionStep = 1 / self.fractionBins
+        meanQual = self.qualSum / np.maximum(self.qualCount, 1)
+        return {'summary': [('reads', self.reads), ('beads', self.beads)],
+                'position_mean_quality': [(str(i + 1), round(float(meanQual[i]), 2)) for i in range(self.maxLength) if self.qualCount[i]],
+                'read_length': [(str(i) if i < self.maxLength else '>={0}'.format(i), int(v)) for i, v in enumerate(self.lengthHist) if v],
+                'ee': [('{0:g}-{1:g}'.format(i * eeStep, (i + 1) * eeStep) if i < self.eeBins else '>={0:g}'.format(self.maxEE), int(v))
+                       for i, v in enumerate(self.eeHist) if v],
+                'fragments_per_bead': [(str(i) if i < self.maxFragment else '>={0}'.format(i), int(v)) for i, v in enumerate(self.fragmentHist) if v],
+                'discarded_fraction': [('{0:g}-{1:g}'.format(i * fractionStep, (i + 1) * fractionStep), int(v)) for i, v in enumerate(self.discardHist) if v]}
+
+    # Write the report, JSON for the .json extension, otherwise TSV (section, bin, value)
+    def write(self, filePath):
+        report = self.report()
+        with open(filePath, 'w') as f:
+            if filePath.endswith('.json'):
+                import json
+                json.dump({key: dict(value) for key, value in report.items()}, f, indent=1)
+            else:
+                for key, value in report.items():
+                    for item in value:
+                        f.write('{0}\t{1}\t{2}\n'.format(key, item[0], item[1]))
+
+
+# Mask the ambiguous bases (not ACGT) and low quality bases (Q < minQ) of a batch of reads
+# Return (mask, starts), mask is True for the masked bases of all reads, concatenated;
+# starts is the start of each read in mask (n + 1) as ee_batch().
+def base_mask(seqs, quals=None, minQ=None, offset=33):
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    starts = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=starts[1:])
+    mask = ~ACGT[np.frombuffer(''.join(seqs).encode('latin-1'), dtype=np.uint8)]
+    if quals is not None and minQ is not None:
+        score = np.frombuffer(''.join(quals).encode('latin-1'), dtype=np.uint8)
+        if len(score) != len(mask):
+            raise ValueError('Sequences and quality scores are not in the same length.')
+        mask |= score < minQ + offset
+    return mask, starts
+
+
+# Return a bool array, True for the reads with any masked base (mask and starts from base_mask())
+def masked_reads(mask, starts):
+    count = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=count[1:])
+    return count[starts[1:]] > count[starts[:-1]]
+
+
+# Return a bool array in the same layout as mask, True for the start of a window (size bp)
+# that is in the read and has no masked base. Window i of read j is clean_windows(...)[starts[j] + i].
+def clean_windows(mask, starts, size):
+    count = np.zeros(len(mask) + size + 1, dtype=np.int64) # padded, windows out of the reads are removed below
+    np.cumsum(mask, out=count[1:len(mask)+1])
+    count[len(mask)+1:] = count[len(mask)]
+    lengths = np.diff(starts)
+    position = np.arange(len(mask)) - np.repeat(starts[:-1], lengths)
+    return (position <= np.repeat(lengths, lengths) - size) & (count[size:size+len(mask)] == count[:len(mask)])
+
+
 #%% Trim a FASTQ record from the end, until MaxError/base lower than the threshold
 # New algorithm with steps
 def ee_rate(score):
@@ -62,6 +227,23 @@ def trunc_ee_rate(seq, p_dict, rate=0.01):
         i += 1
     return [seq[0], seq[1][:pos], seq[2], seq[3][:pos]]
 
+# Truncate a batch of FASTQ records at the longest prefix with EE/bp <= rate (at least 1 base)
+# The cumulative EE of all reads comes from ee_cumulative(), all prefixes are checked in one pass.
+# Return (records, positions), positions is the numpy array of the kept length of each read.
+def trunc_ee_rate_batch(records, rate=0.01, p_array=None):
+    p, starts = ee_batch([i[3] for i in records], p_array)[2:]
+    cumulative = ee_cumulative(p, starts)
+    lengths = np.diff(starts)
+    base = np.arange(len(cumulative)) - np.repeat(starts[:-1], lengths) + 1 # prefix length of each base
+    passed = np.where(cumulative <= rate * base, base, 0)
+    positions = np.zeros(len(records), dtype=np.int64)
+    if len(cumulative):
+        positions[lengths > 0] = np.maximum(np.maximum.reduceat(passed, starts[:-1][lengths > 0]), 1)
+    trimmed = [[record[0], record[1][:pos], record[2], record[3][:pos]]
+               for record, pos in zip(records, positions.tolist())]
+    return trimmed, positions
+
+
 #%% The slower alernative of trunc_ee_rate
 def trunc_ee_rate2(record, p_dict, rate = 0.01):
     # Convert Q score to P
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Convert a bead file between the line-delimited JSON format and the binary bead
+format (.bead). The output format is decided by the extension of the output file,
+binary for .bead, otherwise JSON. The input format is detected automatically.
+
+The binary bead file stores 2-bit packed sequences and the quality scores
+separately for each bead, with an index of all beads at the end of the file.
+It can be read in using metaSeq.io.bead_reader() or metaSeq.io.bead_binary().
+"""
+from __future__ import print_function
+from __future__ import division
+import argparse
+from metaSeq import io as seqIO
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', help='Input bead file (JSON or binary).')
+parser.add_argument('-o', help='Output bead file, binary for the .bead extension, otherwise JSON.')
+args = parser.parse_args()
+
+count = seqIO.bead_convert(args.i, args.o)
+print('Converted {0} beads from {1} to {2}.'.format(count, args.i, args.o))
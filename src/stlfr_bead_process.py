@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+QC (maxEE), dereplicate and filter (fragment range) a bead file in one pass.
+"""
+#%%
+from __future__ import print_function
+from __future__ import division
+from metaSeq import io as seqIO
+from metaSeq import qc as seqQC
+from metaSeq import bead
+from metaSeq import parallel
+from itertools import islice
+import argparse
+import multiprocessing
+import textwrap
+import time
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,\
+                                 description=textwrap.dedent('''\
+                                                             QC (maxEE), dereplicate and filter (fragment range) a bead file in one pass.
+                                                             This is the same as running stlfr_qc_derep.py and stlfr_filter_bead_json.py,
+                                                             the bead file is read and written once. Beads are processed by chunks in a
+                                                             pool of workers, the output keeps the input order.'''))
+parser.add_argument('-i', help='Input bead file (JSON or binary).')
+parser.add_argument('-o', help='Output bead file, binary for the .bead extension, otherwise JSON.')
+parser.add_argument('-maxee', default=1, type=float, help='Threshold of maxEE, default is 1.')
+parser.add_argument('-fr', nargs=2, type=int, help='Fragment range after dereplication, enter two int number MIN MAX (included).')
+parser.add_argument('-phred', default=33, type=int, help='Offset of the quality score, 33 or 64, default is 33.')
+parser.add_argument('-keepZero', action='store_true', default=False, help='By default 0000 bead will be discarded.')
+parser.add_argument('-maxBeads', type=int, help='Fragments found in more than this number of beads are abundant (counted by a sketch in a first pass over the input).')
+parser.add_argument('-abundant', default='drop', choices=['drop', 'flag'], help='Drop the abundant fragments, or only report them (-abundantOut), default is drop.')
+parser.add_argument('-abundantOut', default='abundant_fragments.tsv', help='Abundant fragments and their estimated bead number, default is abundant_fragments.tsv.')
+parser.add_argument('-sketchMem', default=256, type=int, help='Memory of the fragment sketch in MB, default is 256.')
+parser.add_argument('-t', default=1, type=int, help='Number of processes, default is 1.')
+parser.add_argument('-chunk', default=10000, type=int, help='Number of beads sent to a process at once, default is 10000.')
+parser.add_argument('-stats', help='Write QC statistics (histograms) to this file, JSON for the .json extension, otherwise TSV.')
+parser.add_argument('-report', default='stlfr_bead_process.log', help='Statistics report, default is stlfr_bead_process.log.')
+args = parser.parse_args()
+
+if args.fr:
+    minFrag, maxFrag = args.fr
+else:
+    minFrag, maxFrag = None, None
+p_array = seqQC.qual_array(offset=args.phred)
+stats = {}
+
+
+# Write the processed beads of a chunk and add up the counts
+def write_chunk(result, writer):
+    processed, chunkStats = result
+    for item in processed:
+        writer.write(item)
+    for key, value in chunkStats.items():
+        if key == 'qc': # histograms of the chunk
+            stats[key] = stats[key].merge(value) if key in stats else value
+        elif key == 'abundant': # abundant fragments of the chunk
+            stats.setdefault(key, {}).update(value)
+        else:
+            stats[key] = stats.get(key, 0) + value
+
+
+# Process a chunk of beads, a new qcStats for each chunk (merged by write_chunk) with -stats
+# Workers are forked after the sketch is built, so it is not copied for each chunk.
+def process_chunk(chunk):
+    qcStat = seqQC.qcStats(offset=args.phred) if args.stats else None
+    return bead.qcDerepFilter(chunk, args.maxee, minFrag, maxFrag, args.keepZero, p_array, qcStat,
+                              sketch, args.maxBeads, args.abundant)
+
+
+t1 = time.time()
+#%% Count the beads of each fragment in a first pass (the whole input, before QC)
+sketch = None
+if args.maxBeads is not None:
+    sketch = bead.fragmentSketch(memory=args.sketchMem*1024**2)
+    for item in seqIO.bead_reader(args.i):
+        sketch.add(list(item.values())[0], quality=True)
+
+
+#%% QC, derep and filter
+beads = iter(seqIO.bead_reader(args.i))
+chunks = iter(lambda: list(islice(beads, args.chunk)), [])
+pool = multiprocessing.get_context('fork').Pool(args.t) if args.t > 1 else None
+with seqIO.bead_writer(args.o) as f:
+    for result in parallel.imap_ordered(pool, process_chunk, chunks, args.t * 2):
+        write_chunk(result, f)
+if pool is not None:
+    pool.close()
+    pool.join()
+t2 = time.time()
+
+#%% Report
+with open(args.report, 'w') as f:
+    f.write('Input:\t{0}\n'.format(args.i))
+    f.write('Output:\t{0}\n'.format(args.o))
+    f.write('MaxEE:\t{0}\n'.format(args.maxee))
+    f.write('Fragment range:\t{0}\t{1}\n'.format(minFrag, maxFrag))
+    f.write('Input beads:\t{0}\n'.format(stats.get('beads', 0)))
+    f.write('Discarded 0000 beads:\t{0}\n'.format(stats.get('zero_beads', 0)))
+    f.write('Input reads:\t{0}\n'.format(stats.get('reads', 0)))
+    f.write('Reads passed maxEE:\t{0}\n'.format(stats.get('reads_pass_ee', 0)))
+    f.write('Fragments after derep:\t{0}\n'.format(stats.get('fragments_derep', 0)))
+    f.write('Beads without fragment:\t{0}\n'.format(stats.get('empty_beads', 0)))
+    f.write('Beads out of fragment range:\t{0}\n'.format(stats.get('out_of_range_beads', 0)))
+    f.write('Kept beads:\t{0}\n'.format(stats.get('kept_beads', 0)))
+    f.write('Kept fragments:\t{0}\n'.format(stats.get('kept_fragments', 0)))
+    if sketch is not None:
+        f.write('Abundant fragments ({0}, in > {1} beads):\t{2}\n'.format(args.abundant, args.maxBeads, len(stats.get('abundant', {}))))
+        f.write('Abundant fragment occurrences (in all beads):\t{0}\n'.format(stats.get('abundant_occurrences', 0)))
+    f.write('Used {0:.1f} seconds.\n'.format(t2 - t1))
+if 'qc' in stats:
+    stats['qc'].write(args.stats)
+if sketch is not None:
+    with open(args.abundantOut, 'w') as f:
+        for fragment, count in sorted(stats.get('abundant', {}).items(), key=lambda x: -x[1]):
+            f.write('{0}\t{1}\n'.format('\t'.join(fragment), count))
+print('{0} beads pass the QC and derep, {1} kept in the fragment range.'.format(
+    stats.get('kept_beads', 0) + stats.get('out_of_range_beads', 0), stats.get('kept_beads', 0)))
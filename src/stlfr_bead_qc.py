@@ -11,7 +11,8 @@ from __future__ import print_function
 from __future__ import division
 from metaSeq import io as seqIO
 from metaSeq import qc as seqQC
-import json
+from metaSeq import bead
+from itertools import islice
 import argparse
 import textwrap
 import os
@@ -30,38 +31,41 @@ parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpForm
                                         songzewei@genomics.cn
                                         songzewei@outlook.com
                                         ------------------------'''))
-parser.add_argument('-i', help='Input JSON bead file.')
-parser.add_argument('-o', help='Output JSON bead file.')
+parser.add_argument('-i', help='Input bead file (JSON or binary).')
+parser.add_argument('-o', help='Output bead file, binary for the .bead extension, otherwise JSON.')
+parser.add_argument('-stats', help='Write QC statistics (histograms) to this file, JSON for the .json extension, otherwise TSV.')
+parser.add_argument('-phred', default=33, type=int, help='Offset of the quality score, 33 or 64, default is 33.')
 args = parser.parse_args()
 
 beadFile = args.i
 outputFile = args.o
-logFile = 'stlft_bead_qc.log'
+logFile = os.path.splitext(outputFile)[0] + '.log' # log next to the output, as stlfr_split.py
 if os.path.isfile(logFile):
     os.remove(logFile)
 fl = open(logFile, 'a')
 
-p_dict = seqQC.qual_score()
+# EE of the reads is computed for a chunk of beads at once
+p_array = seqQC.qual_array(offset=args.phred)
+qcStat = seqQC.qcStats(offset=args.phred) if args.stats else None
 t1 = time.time()
-with open(outputFile, 'w') as f:
+with seqIO.bead_writer(outputFile) as f:
     count = 0
     keep = 0
-    for bead in seqIO.bead_json(beadFile):
-        count += 1
-        if count % 1000000 == 0:
-            t2 = time.time()
-            fl.write('Processed {0} beads, kept {1} ({2:3.2f}%), used {3:3.1f}s.'.format(count, keep, keep/count*100, t2-t1))
-        filterRecords = []
-        for record in list(bead.values())[0]:
-            if len(record) == 2:
-                if seqQC.ee(record[1], p_dict) < 1:
-                    filterRecords.append([record[0]])
-            else:
-                if seqQC.ee(record[1], p_dict) < 1 and seqQC.ee(record[3], p_dict) < 1:
-                    filterRecords.append([record[0], record[2]])
-        if len(filterRecords) > 0:
-            keep += 1
-            f.write('%s\n' % json.dumps({list(bead.keys())[0]:filterRecords}))
+    beads = iter(seqIO.bead_reader(beadFile))
+    while True:
+        chunk = list(islice(beads, 10000))
+        if not chunk:
+            break
+        for beadQC in bead.maxEE_batch(chunk, maxee=1, p_array=p_array, qcStat=qcStat):
+            count += 1
+            if count % 1000000 == 0:
+                t2 = time.time()
+                fl.write('Processed {0} beads, kept {1} ({2:3.2f}%), used {3:3.1f}s.'.format(count, keep, keep/count*100, t2-t1))
+            if len(list(beadQC.values())[0]) > 0:
+                keep += 1
+                f.write(beadQC)
 t2 = time.time()
 fl.write('Processed {0} beads, kept {1} ({2:3.2f}%), used {3:3.1f}s.'.format(count, keep, keep/count*100, t2-t1))
-fl.close()
\ No newline at end of file
+fl.close()
+if qcStat is not None:
+    qcStat.write(args.stats)
@@ -10,12 +10,11 @@ from __future__ import print_function
 from __future__ import division
 from metaSeq import io as seqIO
 from metaSeq import bead
-import json
 import random
 import argparse
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-i', help='Input beadJson file')
+parser.add_argument('-i', help='Input beadJson or binary bead file')
 parser.add_argument('-o', help='Output short fragment count per bead')
 parser.add_argument('-d', help='Output distribution of count')
 args = parser.parse_args()
@@ -26,15 +25,14 @@ outputDist = args.d
 
 count = {}
 dist = {}
-with open(inputFile, 'r') as f:
-    for line in f:
-        currentBead = bead.beadSequence(json.loads(line.strip('\n')))
-        fragmentCount = len(currentBead.fragments)
-        count[currentBead.barcode] = fragmentCount
-        try:
-            dist[fragmentCount] += 1
-        except KeyError:
-            dist[fragmentCount] = 1
+for item in seqIO.bead_reader(inputFile, quality=False):
+    currentBead = bead.beadSequence(item)
+    fragmentCount = len(currentBead.fragments)
+    count[currentBead.barcode] = fragmentCount
+    try:
+        dist[fragmentCount] += 1
+    except KeyError:
+        dist[fragmentCount] = 1
 
 # Output
 with open(outputDist, 'w') as f:
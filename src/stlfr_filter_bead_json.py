@@ -9,13 +9,14 @@ Created on Wed Jan 30 17:33:41 2019
 from __future__ import print_function
 from __future__ import division
 import argparse
-import json
+from metaSeq import io as seqIO
 from metaSeq import bead
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-i', help='Input JSON-Bead file.')
-parser.add_argument('-o', help='Output JSON-Bead file.')
+parser.add_argument('-i', help='Input JSON-Bead or binary bead file.')
+parser.add_argument('-o', help='Output bead file, binary for the .bead extension, otherwise JSON.')
 parser.add_argument('-fr', nargs='+', type=int, help='Fragment range, enter two int number MIN MAX (included)')
+parser.add_argument('-index', action='store_true', help='Use the bead index to read in only the beads in range (.idx is built for JSON if needed).')
 args = parser.parse_args()
 
 inputFile = args.i
@@ -25,13 +26,18 @@ maxFrag = args.fr[1]
 
 nKeep = 0
 nDiscard = 0
-with open(inputFile, 'r') as f:
-    with open(outputFile, 'w') as f2:
-        for line in f:
-            b = bead.beadSequence(json.loads(line))
+with seqIO.bead_reader(inputFile) as beadFile, seqIO.bead_writer(outputFile) as f2:
+    if args.index: # beads out of range are not read in
+        for item in beadFile.fragment_range(minFrag, maxFrag):
+            f2.write(item)
+            nKeep += 1
+        nDiscard = len(beadFile.index()) - nKeep
+    else:
+        for item in beadFile:
+            b = bead.beadSequence(item)
             fragNumber = len(b.fragments)
             if minFrag <= fragNumber <= maxFrag:
-                f2.write('{0}\n'.format(json.dumps(b.json)))
+                f2.write(b.json)
                 nKeep += 1
             else:
                 nDiscard += 1
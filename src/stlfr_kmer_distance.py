@@ -9,17 +9,23 @@ Created on Thu Jan 31 08:06:52 2019
 from __future__ import print_function
 from __future__ import division
 import argparse
-import json
+import sys
+from metaSeq import io as seqIO
 from metaSeq import bead
 from metaSeq import kmer
 from itertools import combinations
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-i', help='Input JSON-Bead file.')
+parser.add_argument('-i', help='Input JSON-Bead or binary bead file, or a sketch file (stlfr_kmer_sketch.py).')
 parser.add_argument('-t', '--threshold', nargs='+', default=[0.02,0.04], type = float, help='Threshold for distance.')
 parser.add_argument('-rawout', help='Output raw edge file.')
 parser.add_argument('-tout', help='Output thresholded edge file.')
 parser.add_argument('-k', default=21, type=int, help='Kmer size default = 21')
+parser.add_argument('-s', type=int, help='Sketch size, estimate the distance from bottom-k sketches of this size instead of all kmers.')
+parser.add_argument('-minShared', type=int, help='Only calculate the pairs sharing at least this number of kmers (hashes for sketches), default is all pairs.')
+parser.add_argument('-maxFreq', default=1000, type=int, help='With -minShared, skip kmers found in more than this number of beads (0 for no limit), default is 1000.')
+parser.add_argument('-matrix', action='store_true', help='Calculate the distance by blocks of sparse matrix products (needs scipy), only the edges within threshold are kept (-rawout is not written).')
+parser.add_argument('-mem', default=1, type=float, help='Memory (GB) for a block of -matrix or -minShared, default is 1.')
 args = parser.parse_args()
 
 inputFile = args.i
@@ -27,25 +33,55 @@ outputRaw = args.rawout
 outputThreshold = args.tout
 threshold = args.threshold
 kmerSize = args.k
+sketchSize = args.s
 
 # Read in JSON-Bead file
 #Calculate kmer pools for all beads
+# A sketch file is read as it is, kmer and sketch size are taken from the file
 kmerPool = []
 beadCount = 0
-with open(inputFile, 'r') as f:
-    for line in f:
-        b = bead.beadSequence(json.loads(line))
-        kmerPool.append(kmer.kmerCount(b, kmerSize))
+if kmer.is_sketch(inputFile):
+    sketches = kmer.sketch_reader(inputFile)
+    kmerSize, sketchSize = sketches.kmerSize, sketches.sketchSize
+    kmerPool = list(sketches)
+    beadCount = len(kmerPool)
+else:
+    for item in seqIO.bead_reader(inputFile):
+        b = bead.beadSequence(item)
+        if sketchSize:
+            kmerPool.append(kmer.sketchCount(b, kmerSize, sketchSize))
+        else:
+            kmerPool.append(kmer.kmerArrayCount(b, kmerSize))
         beadCount += 1
 print('Found {0} beads.'.format(beadCount))
 
+# With -matrix, the distances are calculated by blocks (kmer.block_distance), only the edges within threshold
+# For sketches the distance is the same Mash estimate as the pairwise calculation.
+if args.matrix:
+    with open(outputThreshold, 'w') as f:
+        f.write('Source\tTArget\tDistance\n')
+        n2 = 0
+        for first, second, distance in kmer.block_distance([i.set for i in kmerPool], kmerSize, threshold, int(args.mem * 1024**3), sketchSize):
+            for i, j, D in zip(first.tolist(), second.tolist(), distance.tolist()):
+                f.write('{0}\t{1}\t{2}\n'.format(kmerPool[i].barcode, kmerPool[j].barcode, D))
+            n2 += len(first)
+    print('Found {0} pairs within threshold.'.format(n2))
+    sys.exit()
+
 # Calculate kmer distance for all pairs
 edge = []
 edgeThreshold = []
 n1 = 0
 n2 = 0
-for pair in combinations(kmerPool, 2):
-    D = kmer.kmerDistance((pair[0].set, pair[1].set)).mashDistance()
+# With -minShared, candidate pairs are taken from an inverted index (kmer.candidate_pairs)
+if args.minShared:
+    first, second, shared = kmer.candidate_pairs([i.set for i in kmerPool], args.minShared, args.maxFreq, int(args.mem * 1024**3))
+    pairs = ((kmerPool[i], kmerPool[j]) for i, j in zip(first.tolist(), second.tolist()))
+    print('Found {0} candidate pairs.'.format(len(first)))
+else:
+    pairs = combinations(kmerPool, 2)
+for pair in pairs:
+    D = kmer.kmerDistance((pair[0].set, pair[1].set), kmerSize, sketchSize).mashDistance()
     edge.append((pair[0].barcode, pair[1].barcode, D))
     if threshold[0] <= D <= threshold[1]:
         edgeThreshold.append((pair[0].barcode, pair[1].barcode, D))
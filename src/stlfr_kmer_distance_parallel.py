@@ -27,6 +27,8 @@ parser.add_argument('-rawout', help='Output raw edge file.')
 parser.add_argument('-tout', help='Output thresholded edge file.')
 parser.add_argument('-k', default=21, type=int, help='Kmer size default = 21')
 parser.add_argument('-j', default = 10, type=int, help='Number of jobs to parallelize.')
+parser.add_argument('-minShared', type=int, help='Only calculate the pairs sharing at least this number of kmers, default is all pairs.')
+parser.add_argument('-maxFreq', default=1000, type=int, help='With -minShared, skip kmers found in more than this number of beads (0 for no limit), default is 1000.')
 args = parser.parse_args()
 
 inputFile = args.i
@@ -41,7 +43,7 @@ def kmerDistanceWorker(pairList, edgeList, n, count):
     print(len(pairList))
     tempList = edgeList[n]
     for kmerPair in pairList:
-        D = kmer.kmerDistance((kmerPair[0].set, kmerPair[1].set)).mashDistance()
+        D = kmer.kmerDistance((kmerPair[0].set, kmerPair[1].set), kmerSize).mashDistance()
         tempList.append((kmerPair[0].barcode, kmerPair[1].barcode, D))
         count[n] += 1
     edgeList[n] = tempList
@@ -54,7 +56,7 @@ def main():
     with open(inputFile, 'r') as f:
         for line in f:
             b = bead.beadSequence(json.loads(line))
-            kmerPool.append(kmer.kmerCount(b, kmerSize))
+            kmerPool.append(kmer.kmerArrayCount(b, kmerSize))
             beadCount += 1
     print('Found {0} beads.'.format(beadCount))
 
@@ -67,9 +69,15 @@ def main():
     print('Starting mash distance ...')
 
     # Divide the kmer pair pool
+    # With -minShared, only the candidate pairs from an inverted index (kmer.candidate_pairs)
     pairPool = []
-    for pair in combinations(kmerPool,2):
-        pairPool.append(pair)
+    if args.minShared:
+        first, second, shared = kmer.candidate_pairs([i.set for i in kmerPool], args.minShared, args.maxFreq)
+        for i, j in zip(first.tolist(), second.tolist()):
+            pairPool.append((kmerPool[i], kmerPool[j]))
+    else:
+        for pair in combinations(kmerPool,2):
+            pairPool.append(pair)
     size = len(pairPool)
     print('Total is {0} pairs.'.format(size))
     step = size // job
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sketch the beads (bottom-k MinHash of the canonical kmers) into a sketch file.
+"""
+#%%
+from __future__ import print_function
+from __future__ import division
+from metaSeq import io as seqIO
+from metaSeq import bead
+from metaSeq import kmer
+from metaSeq import parallel
+from itertools import islice
+import argparse
+import multiprocessing
+import textwrap
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,\
+                                 description=textwrap.dedent('''\
+                                                             Sketch the beads (bottom-k MinHash of the canonical kmers, as mash sketch) into a sketch file.
+                                                             The sketch file can be the input of stlfr_kmer_distance.py for Mash distance of all bead pairs.
+                                                             Beads are sketched by chunks in a pool of workers, the output keeps the input order.'''))
+parser.add_argument('-i', help='Input bead file (JSON or binary).')
+parser.add_argument('-o', help='Output sketch file.')
+parser.add_argument('-k', default=21, type=int, help='Kmer size (up to 32), default is 21.')
+parser.add_argument('-s', default=1000, type=int, help='Sketch size (number of hashes per bead), default is 1000.')
+parser.add_argument('-t', default=1, type=int, help='Number of processes, default is 1.')
+parser.add_argument('-chunk', default=1000, type=int, help='Number of beads sent to a process at once, default is 1000.')
+args = parser.parse_args()
+
+
+# Sketch a chunk of beads
+def sketch_chunk(chunk):
+    return [kmer.sketchCount(bead.beadSequence(item), args.k, args.s) for item in chunk]
+
+
+beads = seqIO.bead_reader(args.i)
+chunks = iter(lambda: list(islice(beads, args.chunk)), [])
+pool = multiprocessing.get_context('fork').Pool(args.t) if args.t > 1 else None
+with kmer.sketch_writer(args.o, args.k, args.s) as f:
+    for sketches in parallel.imap_ordered(pool, sketch_chunk, chunks, args.t * 2):
+        f.write(sketches)
+if pool is not None:
+    pool.close()
+    pool.join()
+print('Sketched {0} beads (k={1}, s={2}).'.format(f.count, args.k, args.s))
@@ -10,7 +10,6 @@ from __future__ import print_function
 from __future__ import division
 import argparse
 from metaSeq import io as seqIO
-import json
 import textwrap
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -27,7 +26,8 @@ parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpForm
 parser.add_argument('-a', help='FASTQ file of assembled reads.')
 parser.add_argument('-f', help='Unassembled forward reads.')
 parser.add_argument('-r', help='Unassembled reverse reads.')
-parser.add_argument('-o', help='Output bead file in JSON format.')
+parser.add_argument('-o', help='Output bead file, binary for the .bead extension, otherwise JSON.')
+parser.add_argument('-unsorted', action='store_true', default=False, help='Input files are not sorted by bead, read all beads into memory before writing.')
 #parser.add_argument('-fasta', action='store_true', default=False)
 args = parser.parse_args()
 assemFile = args.a
@@ -42,11 +42,19 @@ logFile = 'stlfr_mergepairs2json.log'
 with open(logFile, 'w') as f:
     f.write('Reading in the files.\n')
 
-bead = {} # Dictionary for storing bead
-bead = seqIO.mergepairs2bead(assemFile, fwdFile, revFile)
+# By default the files are sorted by bead (stlfr_split.py output), beads are merged from the three
+# files and written one by one. With -unsorted, all beads are kept in a dictionary first.
+if args.unsorted:
+    bead = seqIO.mergepairs2bead(assemFile, fwdFile, revFile)
+    beads = ({key: value} for key, value in bead.items())
+else:
+    beads = seqIO.mergepairs2bead_stream(assemFile, fwdFile, revFile, parallel=True)
 
 with open(logFile, 'a') as f:
-    f.write('Writing to JSON file.\n')
-with open(outputFile, 'w') as f:
-    for key, value in bead.items():
-        f.write('%s\n' % json.dumps({key:value}))
\ No newline at end of file
+    f.write('Writing to {0}.\n'.format(outputFile))
+with seqIO.bead_writer(outputFile) as f:
+    for item in beads:
+        f.write(item)
+    beadCount = f.count
+with open(logFile, 'a') as f:
+    f.write('Wrote {0} beads.\n'.format(beadCount))
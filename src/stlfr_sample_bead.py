@@ -10,14 +10,13 @@ Created on Wed Aug 15 14:25:43 2018
 from __future__ import print_function
 from __future__ import division
 from metaSeq import io as seqIO
-import json
-import random
 import argparse
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-i', help='Input file to sample')
-parser.add_argument('-o', help='Output file')
+parser.add_argument('-i', help='Input bead file to sample (JSON or binary)')
+parser.add_argument('-o', help='Output file, binary for the .bead extension, otherwise JSON')
 parser.add_argument('-n', type=int, help='Number of beads to sample')
+parser.add_argument('-seed', type=int, default=None, help='Random seed.')
 parser.add_argument('-not_gz', action='store_false', help='Specify if the input is not a gz file, in most case you do not need it.')
 args = parser.parse_args()
 
@@ -26,17 +25,13 @@ outputFile = args.o
 n = args.n
 not_gz = args.not_gz
 
-beadJson = []
-with open(inputFile, 'r') as f:
-    for line in f:
-        beadJson.append(line)
+# Beads are located with the index (sidecar .idx file for JSON, built at the first time),
+# only the sampled beads are read in.
+with seqIO.bead_reader(inputFile) as beadFile:
+    print('Found {0} beads.'.format(len(beadFile.index())))
+    randomBeads = beadFile.sample(n, seed=args.seed)
 
-print('Found {0} beads.'.format(len(beadJson)))
-# print(beadJson[list(beadJson.keys())[0]])
-# Get the n barcode randomly
-randomBeads = random.sample(beadJson, n)
-
-with open(outputFile, 'w') as f:
-    for line in randomBeads:
-        f.write('{0}'.format(line))
-print('Randomly sampled {0} beads into {1}.'.format(n, outputFile))
\ No newline at end of file
+with seqIO.bead_writer(outputFile) as f:
+    for bead in randomBeads:
+        f.write(bead)
+print('Randomly sampled {0} beads into {1}.'.format(n, outputFile))
@@ -24,16 +24,22 @@ Each barcode can tolerant 1 mutation. The three barcodes are identify from the
 54 bp string using the pattern 10 + 6 + 10 + 18 + 10.
 
 For a general BGISEQ PE100 lane with 600M reads, the split usually takes 8 hrs.
+Use -threads to decode the barcodes with multiple processes, reads are sent to
+the workers by trunk (-trunk) and the output is the same as in a single process.
+Only the barcode region of R2 is sent to the workers and the barcode index array
+is sent back, the records are built in the main process. Reading the FASTQ files
+and sorting the reads also stay in the main process, so the speed up levels off
+after a few threads.
 
 The current output is in FASTA format. However, this is not an efficient format
 for stLFR data. A better alternative is to save as a Python dictionary using
 bead (barcode) as the key. This option will be added later or you can parse the
 data into Python dictionary yourself.
 
-You will need to request super memory at the super computer for this task. A low
-memory version is possible, but may take much longer time. We don't have plan
-for a low memory version in the short run unless there is a urgent need. Contact
-us if you need one.
+Reads are sorted by bead with a bounded memory (-mem, in GB, 4 by default). When
+the reads in memory reach the limit, they are sorted and written to a temporary
+run file (in -tmp, the output folder by default). All runs are merged at the end,
+so the output is orderred by bead (barcode set).
 
 @author: Zewei Song
 @email: songzewei@genomics.cn or songzewei@outlook.com
@@ -42,11 +48,16 @@ us if you need one.
 from __future__ import print_function
 from __future__ import division
 from metaSeq import io as seqIO
+from metaSeq import barcode as seqBarcode
+from metaSeq import parallel
 import sys
 import textwrap
 import argparse
 import time
 import json
+import os
+import multiprocessing
+from collections import deque
 #import gzip
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      epilog=textwrap.dedent('''\
@@ -66,6 +77,10 @@ parser.add_argument('-o', help='Output base for FASTQ or JSON.')
 parser.add_argument('-fastq', action='store_true', help='Turn on output to FASTQ, suffix will be added for four files.')
 parser.add_argument('-json', action='store_true', help='Turn on output to JSON format, will write to one file with .json extension.')
 parser.add_argument('-bl', default='42', help='Specify the length of barcode string, 42 or 54 bp.')
+parser.add_argument('-threads', default=1, type=int, help='Number of processes for decoding the barcodes, default is 1.')
+parser.add_argument('-trunk', default=100000, type=int, help='Number of read pairs sent to a process every time, default is 100,000.')
+parser.add_argument('-mem', default=4, type=float, help='Memory (GB) for sorting the reads in memory, default is 4.')
+parser.add_argument('-tmp', default=None, help='Folder for the temporary sorted runs, default is the output folder.')
 #parser.add_argument('-not_gz', action='store_false', help='Specify if the input is not a gz file, in most case you do not need it.')
 args = parser.parse_args()
 r1File = args.r1
@@ -73,75 +88,20 @@ r2File = args.r2
 barcodeFile = args.b
 base = args.o
 bl = args.bl
-not_gz = args.not_gz
+threads = args.threads
+trunkSize = args.trunk
+memory = int(args.mem * 1024**3)
+tempDir = args.tmp or os.path.dirname(os.path.abspath(base))
 t1 = time.time()
 
 if not args.fastq and not args.json:
     print('Please specify at least one output format.\n')
     sys.exit()
 #%% Functions
-# Return the Reverse Compliment of a sequence
-def rc(seq):
-    replace_dict = {'A':'T', 'T':'A','C':'G','G':'C'}
-    reverse = seq[::-1].upper()
-    rc = ''
-    for base in reverse:
-        rc += replace_dict[base]
-    return rc
-
-
-# Generate all possible 1 SNP mutation of a given sequence
-    # Original sequence is NOT included in the output
-    # RC is not considered
-    # There is l x 3 + 1 sequences including the original one
-def snp_list(seq):
-    snp_dict = {'A':['T','C','G'], 'T':['A','C','G'],\
-                'C':['A','T','G'], 'G':['A','T','C']}
-    snp_seqs = []
-    for index, base in enumerate(seq): # mutate per base
-        for mutate in snp_dict[base]:
-            seqMutate = seq
-            seqMutate = seqMutate[:index] + mutate + seqMutate[index+1:]
-            snp_seqs.append(seqMutate)
-    return snp_seqs
-
-
-# Detect the three 10 bp barcode in the last 54 bp of Read 2
-    # Currently using: 10 + 6 + 10 + 18 + 10 (three sets of 10 base barcode)
-    # Lates barcode is 42bp 10 + 6 + 10 + 6 + 10 (Cuurently used by CNGB)
-    # BAsed on our latest test on 2018-6-15, they may accidentally sequence R2
-    # as 154 bp while using the 42 bp system. If this is the case, use the first
-    # 142 bp.
-def barcode_set(seq, bl, offset):
-    if bl == '54':
-        return [seq[100+offset:110+offset], seq[116+offset:126+offset], seq[144+offset:154+offset]]
-    elif bl == '42':
-        return [seq[100+offset:110+offset], seq[116+offset:126+offset], seq[132+offset:142+offset]]
-
-
-# Return the number barcode set if exist
-def number_set(barcodes, forwardDict, forwardSnpDict, reverseDict):
-    number = []
-    for item in barcodes:
-        try:
-            number.append(forwardDict[item])
-        except:
-            try:
-                number.append(forwardSnpDict[item])
-            except KeyError:
-                #print('forward: {0}'.format(item))
-                break
-    if len(number) == 3: # barcode set (all three barcodes) found in the forward direction)
-        return '_'.join(number)
-    else: # Does not found barcode in the forward direction
-        number = []
-        for item in barcodes:
-            try:
-                number.append(reverseDict[rc(item)])
-            except KeyError: # At least one barcode not found in reverse direction either
-                #print('reverse: {0}'.format(item))
-                return None
-    return '_'.join(number)
+# Return the barcode index array (barcodeDecoder.decode_batch) for the barcode region of R2 sequences
+# This is the job of a worker process in the -threads mode
+def decode_trunk(regions):
+    return decoder.decode_batch(regions, first=regionStart)
 
 ''' Dyfunced now, RIP.
 # Iterator for two files
@@ -181,137 +141,107 @@ class sequence_twin(object):
         return record[0], record[1]
 '''
 #%% Read in the barcode list
-# Forward and Reverse barcodes are saved in two Dictionaries.
+# All barcodes with up to 1 mismatch are indexed by their 20-bit code (see metaSeq.barcode)
 print('Reading in the barcode list from {0} ...'.format(barcodeFile))
-# Save to a Dict use barcode number as key and barcode sequence as value
-barcodeDictForward = {}
-with open(barcodeFile, 'r') as f:
-    for line in f:
-        line = line.strip('\n').split('\t')
-        barcodeDictForward[line[1]] = [line[0]]
-
-# Add all possible 1 SNP mutations for all barcode
-barcodeSnpDictForward = {}
-for key, value in barcodeDictForward.items():
-    barcodeSnpDictForward[key] = snp_list(value[0])
-
-# Create the RC Dict
-barcodeDictReverse = {}
-for key, value in barcodeDictForward.items():
-    rc_seq = rc(value[0]) # The first sequence is the original Forward barcode
-    barcodeDictReverse[key] = [rc_seq] + snp_list(rc_seq)
-
-# Convert number:barcode to barcode:number
-numberDictForward = {}
-numberSnpDictForward = {}
-numberDictReverse = {}
-
-for key, value in barcodeDictForward.items():
-    for barcode in value:
-        numberDictForward[barcode] = key
-for key, value in numberSnpDictForward.items():
-    for barcode in value:
-        numberSnpDictForward[barcode] = key
-for key, value in barcodeDictReverse.items():
-    for barcode in value:
-        numberDictReverse[barcode] = key
-print('{0} unique barcode possibilities in Forward.'.format(len(numberDictForward)))
-print('{0} unique barcode possibilities in Reverse.'.format(len(numberDictReverse)))
+decoder = seqBarcode.barcodeDecoder(barcodeFile, bl=bl, offsets=[0,-1,1,-2,2])
+print('{0} barcodes, {1} unique barcode possibilities.'.format(len(decoder.numbers), len(decoder)))
 #with open('split.log.txt', 'w') as f:
 #    f.write('Built barcode dictionary\n')
 
 
 #%% Read in R1 and R2 file
-# Assign barocde on the fly, and save in memory (This will take up a LARGE trunk of memory)
-# The two number Dictionary contains all possible sequences with 1 base Error
-beadDict = {} # This is the dictionary that organizes seqs by bead (barcode set)
-beadError = {'0_0_0':[]}  # This is the dicionary that organizes seqs without barcode
+# Assign barocde on the fly, reads are sorted by bead within the memory limit
+# A sorted record is (bead, R1 label, seq, +, qual, R2 label, seq, +, qual)
+beadSorter = seqIO.bead_sorter(9, memory=memory, tempDir=tempDir)
 
 logFile = base + '.log'
 
-seqs = seqIO.sequence_twin(r1File, r2File)
 count = 0
 error_count = 0
-offsets = [0,-1,1,-2,2]
-for r1, r2 in seqs:
-    count += 1
-    if count % 1000000 == 0: # Report per 1 million reads
-        with open(logFile, 'w') as f:
-            f.write('Processed {0:8.2f} M reads\n'.format(count/1000000))
-        #break
-    for offset in offsets:
-        bead = number_set(barcode_set(r2[1], bl,offset), numberDictForward, numberSnpDictForward, numberDictReverse)
-        if bead:
-            break
 
-    if bead:
-        r1[0] = r1[0][:-2] + '/' + bead + '/1'
-        r2[0] = r2[0][:-2] + '/' + bead + '/2'
-        r2[1] = r2[1][:100]
-        r2[3] = r2[3][:100]
-        try:
-            beadDict[bead].append([r1, r2])
-        except KeyError:
-            beadDict[bead] = [[r1, r2]]
+# Reads without eligible barcode are written on the fly
+if args.fastq:
+    r1ErrorFile = open(base + '.r1_error.fq', 'w')
+    r2ErrorFile = open(base + '.r2_error.fq', 'w')
+
+
+# Put a trunk of read pairs into beads using the decoded barcodes (in the same order)
+def assign_trunk(trunk1, trunk2, index):
+    global count, error_count
+    for r1, r2, bead in zip(trunk1, trunk2, decoder.labels(index)):
+        count += 1
+        if count % 1000000 == 0: # Report per 1 million reads
+            with open(logFile, 'w') as f:
+                f.write('Processed {0:8.2f} M reads\n'.format(count/1000000))
+        if bead:
+            beadSorter.add((bead, r1[0][:-2] + '/' + bead + '/1', r1[1], r1[2], r1[3],
+                            r2[0][:-2] + '/' + bead + '/2', r2[1][:100], r2[2], r2[3][:100]))
+        else:
+            if args.fastq:
+                r1ErrorFile.write('@{0}\n{1}\n{2}\n{3}\n'.format(r1[0][:-2] + '/' + '0_0_0' + '/1', r1[1], r1[2], r1[3]))
+                r2ErrorFile.write('@{0}\n{1}\n{2}\n{3}\n'.format(r2[0][:-2] + '/' + '0_0_0' + '/1', r2[1][:100], r2[2], r2[3][:100]))
+            error_count += 1
+
+
+# With -threads > 1, the barcode regions of each trunk are sent to a pool of workers (parallel.imap_ordered),
+# results are collected in the input order, at most 2 x threads trunks are in flight. The pool is forked before
+# the readers start the background decompression (threads and pipes are not copied to the workers).
+# R1 and R2 are decompressed in the background, and read in by trunk
+# The readers are closed at the end (also on error), the background decompression is stopped.
+regionStart, regionEnd = decoder.region()
+if threads > 1:
+    pool = multiprocessing.get_context('fork').Pool(threads) # workers inherit the barcode decoder
+with seqIO.sequence_twin_block_trunk(r1File, r2File, trunk_size=trunkSize, parallel=True) as trunks:
+    if threads > 1:
+        pending = deque() # trunks waiting for their barcodes, in the same order as the results
+        def trunk_regions():
+            for trunk1, trunk2 in trunks:
+                pending.append((trunk1, trunk2))
+                yield [r2[1][regionStart:regionEnd] for r2 in trunk2]
+        for index in parallel.imap_ordered(pool, decode_trunk, trunk_regions(), threads * 2):
+            trunk1, trunk2 = pending.popleft()
+            assign_trunk(trunk1, trunk2, index)
+        pool.close()
+        pool.join()
     else:
-        r1[0] = r1[0][:-2] + '/' + '0_0_0' + '/1'
-        r2[0] = r2[0][:-2] + '/' + '0_0_0' + '/1'
-        r2[1] = r2[1][:100]
-        r2[3] = r2[3][:100]
-        beadError['0_0_0'].append([r1, r2])
-        error_count += 1
+        for trunk1, trunk2 in trunks:
+            assign_trunk(trunk1, trunk2, decoder.decode_batch([r2[1] for r2 in trunk2]))
+
+if args.fastq:
+    r1ErrorFile.close()
+    r2ErrorFile.close()
+
+#%% Merge the sorted runs and write the beads
+# Output files are written in one pass over the sorted reads
+bead_count = 0
+run_count = len(beadSorter.runs)
+if args.fastq:
+    print('Writing to R1 and R2 files ...')
+    r1Output = open(base + '.r1_split.fq', 'w')
+    r2Output = open(base + '.r2_split.fq', 'w')
+if args.json:
+    print('Writing to JSON file ...')
+    jsonOutput = open(base + '.json', 'w')
+for bead, records in beadSorter.beads():
+    bead_count += 1
+    if args.fastq:
+        r1Output.write(''.join(['@{1}\n{2}\n{3}\n{4}\n'.format(*i) for i in records]))
+        r2Output.write(''.join(['@{5}\n{6}\n{7}\n{8}\n'.format(*i) for i in records]))
+    if args.json:
+        jsonOutput.write('%s\n' % json.dumps({bead: [[i[2], i[4], i[6], i[8]] for i in records]}))
+if args.fastq:
+    r1Output.close()
+    r2Output.close()
+if args.json:
+    jsonOutput.close()
 
 with open(logFile, 'w') as f1:
     f1.write('Processed {0:8.2f} M reads\n'.format(count/1000000))
     f1.write('Processed finished.\n')
-    f1.write('Found {0} beads.\n'.format(len(beadDict)))
-
-    if args.fastq:
-        r1OutputFile = base + '.r1_split.fq'
-        r2OutputFile = base + '.r2_split.fq'
-        r1Error = base + '.r1_error.fq'
-        r2Error = base + '.r2_error.fq'
-
-        print('Writing to R1 file ...')
-        with open(r1OutputFile, 'w') as f:
-            for key, value in beadDict.items():
-                for record in value:
-                    record[0][0] = '@' + record[0][0]
-                    for line in record[0]:
-                        f.write('{0}\n'.format(line))
-
-        print('Writing to R2 file ...')
-        with open(r2OutputFile, 'w') as f:
-            for key, value in beadDict.items():
-                for record in value:
-                    record[1][0] = '@' + record[1][0]
-                    for line in record[1]:
-                        f.write('{0}\n'.format(line))
-
-        print('Writing to R1 Error file ...')
-        with open(r1Error, 'w') as f:
-            for key, value in beadError.items():
-                for record in value:
-                    record[0][0] = '@' + record[0][0]
-                    for line in record[0]:
-                        f.write('{0}\n'.format(line))
-
-        print('Writing to R2 Error file ...')
-        with open(r2Error, 'w') as f:
-            for key, value in beadError.items():
-                for record in value:
-                    record[1][0] = '@' + record[1][0]
-                    for line in record[1]:
-                        f.write('{0}\n'.format(line))
+    f1.write('Found {0} beads.\n'.format(bead_count))
+    f1.write('Sorted with {0} temporary runs.\n'.format(run_count))
     if args.json:
         f1.write('Output as JSON format.\n' )
-        jsonOutputFile = base + '.json'
-        with open(jsonOutputFile, 'w') as f:
-            for key, value in beadDict.items():
-                currentBead = {key:[]}
-                currentBead[key] = [seqIO.fastq2list(i[0], i[1]) for i in value]
-                f.write('%s\n' % json.dumps(currentBead))
-
     f1.write('{0} total seqs.\n'.format(count))
     f1.write('{0} seqs do not have eligible barcode.\n'.format(error_count))
     t2 = time.time()
@@ -9,7 +9,8 @@ Created on Wed Jun  6 10:47:32 2018
 #%%
 from __future__ import print_function
 from __future__ import division
-#from metaSeq import io as seqIO
+from metaSeq import io as seqIO
+from metaSeq import barcode as seqBarcode
 import textwrap
 import argparse
 import time
@@ -31,6 +32,8 @@ parser.add_argument('-b', default='barcode.list', help='Forward barcode list, th
 parser.add_argument('-o', help='Output file, suffix will be added for four files.')
 parser.add_argument('-s', default=1000000, help='Number of record read in every time, default is 1 million.')
 parser.add_argument('-not_gz', action='store_false', help='Specify if the input is gz file, in most case you do not need it.')
+parser.add_argument('-mem', default=4, type=float, help='Memory (GB) for sorting the reads in memory, default is 4.')
+parser.add_argument('-tmp', default=None, help='Folder for the temporary sorted runs, default is the output folder.')
 args = parser.parse_args()
 r1File = args.r1
 r2File = args.r2
@@ -40,65 +43,13 @@ not_gz = args.not_gz
 t1 = time.time()
 
 size = int(args.s)
+memory = int(args.mem * 1024**3)
+tempDir = args.tmp or os.path.dirname(os.path.abspath(outputFile))
 
 #barcodeFile = 'barcode.list'
 #r1File = 'r1.fq'
 #r2File = 'r2.fq'
 #%% Functions
-# Return the Reverse Compliment of a sequence
-def rc(seq):
-    replace_dict = {'A':'T', 'T':'A','C':'G','G':'C'}
-    reverse = seq[::-1].upper()
-    rc = ''
-    for base in reverse:
-        rc += replace_dict[base]
-    return rc
-    
-
-# Generate all possible 1 SNP mutation of a given sequence
-    # Original sequence is NOT included in the output
-    # RC is not considered
-    # There is l x 3 + 1 sequences including the original one
-def snp_list(seq):
-    snp_dict = {'A':['T','C','G'], 'T':['A','C','G'],\
-                'C':['A','T','G'], 'G':['A','T','C']}
-    snp_seqs = []
-    for index, base in enumerate(seq): # mutate per base
-        for mutate in snp_dict[base]:
-            seqMutate = seq
-            seqMutate = seqMutate[:index] + mutate + seqMutate[index+1:]
-            snp_seqs.append(seqMutate)
-    return snp_seqs
-
-
-# Detect the three 10 bp barcode in the last 54 bp of Read 2
-    # Currently using: 10 + 6 + 10 + 18 + 10 (three sets of 10 base barcode)
-def barcode_set(seq):
-    return [seq[100:110], seq[116:126], seq[144:154]]
-
-
-# Return the number barcode set if exist
-def number_set(barcodes, forwardDict, reverseDict):
-    number = []
-    for item in barcodes:
-        try:
-            number.append(forwardDict[item])
-        except KeyError:
-            #print('forward: {0}'.format(item))
-            break
-    if len(number) == 3: # barcode set (all three barcodes) found in the forward direction)
-        return '_'.join(number)
-    else: # Does not found barcode in the forward direction
-        number = []
-        for item in barcodes:
-            try:
-                number.append(reverseDict[rc(item)])
-            except KeyError: # At least one barcode not found in reverse direction either
-                #print('reverse: {0}'.format(item))
-                return None
-    return '_'.join(number)
-
-
 # Iterator for two files
 # It only work for files with ABSOLUTELY corresponding record.
 class sequence_twin_trunk(object):
@@ -145,81 +96,28 @@ class sequence_twin_trunk(object):
             r2_trunk.append(r2)
         return r1_trunk, r2_trunk
 
-tempDict = {}
-for i in range(1536):
-    tempDict[i+1] = str(i+1) + '.temp'
-
-#%% Save to a Dict use barcode number as key and barcode sequence as value
-barcodeDictForward = {}
-with open(barcodeFile, 'r') as f:
-    for line in f:
-        line = line.strip('\n').split('\t')
-        barcodeDictForward[line[1]] = [line[0]]
-
-# Add all possible 1 SNP mutations for all barcode
-for key, value in barcodeDictForward.items():
-    barcodeDictForward[key] += snp_list(value[0])
-
-# Create the RC Dict
-barcodeDictReverse = {}
-for key, value in barcodeDictForward.items():
-    rc_seq = rc(value[0]) # The first sequence is the original Forward barcode
-    barcodeDictReverse[key] = [rc_seq] + snp_list(rc_seq)
-
-# Convert number:barcode to barcode:number
-numberDictForward = {}
-numberDictReverse = {}
-
-for key, value in barcodeDictForward.items():
-    for barcode in value:
-        numberDictForward[barcode] = key
-for key, value in barcodeDictReverse.items():
-    for barcode in value:
-        numberDictReverse[barcode] = key
+#%% Index all barcodes with up to 1 mismatch by their 20-bit code (see metaSeq.barcode)
+# The 54 bp barcode string is used, without offset
+decoder = seqBarcode.barcodeDecoder(barcodeFile, bl='54', offsets=[0])
 
 
 #%% Read in R1 and R2 file
-# The two number Dictionary contains all possible sequences with 1 base Error
-
-beadError = {'0_0_0':[]}  # This is the dicionary that organizes seqs without barcode
+# Reads are sorted by bead with a bounded memory (-mem), sorted runs are spilled to -tmp
+# and merged at the end (see metaSeq.io.bead_sorter)
+beadSorter = seqIO.bead_sorter(5, memory=memory, tempDir=tempDir)
+error_count = 0 # Reads without eligible barcode
 trunks = sequence_twin_trunk(r1File, r2File, fastx='q', trunk_size = size, gz=not_gz)
 
-# Assign read into bins using the first barcode as key
 for t1, t2 in trunks:
-    beadDict = {} # This is the dictionary that organizes seqs by bead (barcode set)
-    for i in range(1536):
-        beadDict[i+1] = []
-    for r1, r2 in zip(t1, t2):
-        bead = number_set(barcode_set(r2[1]), numberDictForward, numberDictReverse)
+    beads = decoder.labels(decoder.decode_batch([r2[1] for r2 in t2])) # decode the whole trunk at once
+    for r1, r2, bead in zip(t1, t2, beads):
         if bead:
-            firstBarcode = int(bead.split('_')[0])
-            beadDict[firstBarcode].append((bead, r1[1], r1[3], r2[1][:100], r2[3][:100]))
+            beadSorter.add((bead, r1[1], r1[3], r2[1][:100], r2[3][:100]))
         else:
-            beadError['0_0_0'].append((r1[1], r1[3], r2[1][:100], r2[3][:100]))
-
-    # Write to temp file:
-    for key, value in beadDict.items():
-        if len(value) > 0:
-            with open(tempDict[key], 'a') as f:
-                for line in value:
-                    f.write('{0}\n'.format('\t'.join(line)))
-
-#%% Order each temp file by bead, and write to a new file
-#outputFile = 'orderred.fq'
-for key, value in tempDict.items():
-    temp = []
-    try:
-        with open(value, 'r') as f:
-            for line in f:
-                temp.append(line.strip('\n').split('\t'))
-        temp.sort(key=lambda x:x[0])
-        with open(outputFile, 'a') as f:
-            for line in temp:
-                f.write('{0}\n'.format('\t'.join(line)))
-    except FileNotFoundError:
-        pass
+            error_count += 1
 
-#%% Remove temp files
-for key, value in tempDict.items():
-    if os.path.isfile(value):
-        os.remove(value)
\ No newline at end of file
+#%% Merge the sorted runs, and write to the output file ordered by bead
+with open(outputFile, 'w') as f:
+    for line in beadSorter:
+        f.write('{0}\n'.format('\t'.join(line)))
+print('{0} reads without eligible barcode.'.format(error_count))
@@ -9,41 +9,58 @@ from __future__ import print_function
 from __future__ import division
 from metaSeq import io
 from metaSeq import qc
+from metaSeq import parallel
 import argparse
+import multiprocessing
 import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', help='Input FASTQ file.')
-parser.add_argument('-o', help='Output FASTQ file.')
+parser.add_argument('-o', help='Output FASTQ file, gzip compressed if ends with .gz')
 parser.add_argument('-r', help='Expected Error rate, EE/bp')
 parser.add_argument('-l', help='Minimum length to keep, >=')
 parser.add_argument('-t', default=100000, help='Trunk size. By default is 100,000')
+parser.add_argument('-phred', default=33, type=int, help='Offset of the quality score, 33 or 64. By default is 33')
+parser.add_argument('-threads', default=1, type=int, help='Number of processes for trimming the trunks. By default is 1')
+parser.add_argument('-gz', type=int, help='Compress the output with gzip at this level (0-9), .gz is added to the output if needed')
 args = parser.parse_args()
 input_file = args.i
 output_file = args.o
+if args.gz is not None and not output_file.endswith('.gz'):
+    output_file += '.gz'
+    print('Output is compressed, writing to {0}'.format(output_file))
 rate = float(args.r)
 ml = int(args.l)
 trunk = int(args.t)
-t1 = time.clock()
+threads = args.threads
+t1 = time.time()
 print('Reading {0} by trunk ({1}) ...'.format(input_file, trunk))
 #%% Truncate filter at maxE rate 0.01
-input_seq = io.sequence_trunk(input_file, fastx='q', trunk_size=trunk)
-p_dict = qc.qual_score()
+p_array = qc.qual_array(offset=args.phred)
 
+
+# Truncate a trunk and keep the records not shorter than ml
+# Return the number of input records and the kept records
+def trim_trunk(trunk):
+    filtered, positions = qc.trunc_ee_rate_batch(trunk, rate=rate, p_array=p_array)
+    return len(trunk), [record for record, keep in zip(filtered, (positions >= ml).tolist()) if keep]
+
+
+# With -threads > 1, trunks are trimmed in a pool of workers (parallel.imap_ordered) and written in the input
+# order, at most 2 x threads trunks are in flight. The pool is forked before the reader starts the
+# background decompression (threads and pipes are not copied to the workers).
 i = 0
-j = 0
-c = 0
-for trunk in input_seq:
-    c += 1
-    content = []
-    for record in trunk:
-        i += 1
-        filtered = qc.trunc_ee_rate(record, p_dict, rate=rate)
-        if len(filtered[1]) >= ml:
-            content.append(filtered)
-            j += 1
-    count = io.write_seqs(content, output_file, fastx='q', mode='a')
+pool = multiprocessing.get_context('fork').Pool(threads) if threads > 1 else None
+with io.sequence_trunk(input_file, trunk_size=trunk, parallel=True) as input_seq, \
+        io.sequence_writer(output_file, fastx='q', level=args.gz) as f:
+    for count, records in parallel.imap_ordered(pool, trim_trunk, input_seq, threads * 2):
+        i += count
+        f.write(records)
+    j = f.count
+if pool is not None:
+    pool.close()
+    pool.join()
 print('Expected error rate = {0}, Minimum length = {1}'.format(rate, ml))
 print('Filtered {0}, kept {1}'.format(i, j))
-t2 = time.clock()
-print('Use {0} s.'.format(t2-t1))
\ No newline at end of file
+t2 = time.time()
+print('Use {0} s.'.format(t2-t1))